@@ -68,3 +68,73 @@ for fname, n in [('rand01', 100),
     print(len(str(d1)), len(str(d2)))
     print('%0.0f%%' % (100*len(r2)/len(r1)))
     print('equal:', d1 == d2)
+
+
+# === Concurrency stress test: one serializer shared by many threads
+
+import threading
+
+print('-' * 10 + ' threads')
+d = json.load(open('../_data/rand02.json', 'rt', encoding='utf-8'))
+shared = bsdf.BsdfSerializer()
+errors = []
+
+def worker(n):
+    try:
+        for i in range(n):
+            assert shared.decode(shared.encode(d)) == d
+    except Exception as err:
+        errors.append(err)
+
+for n_threads in (1, 2, 4, 8):
+    del errors[:]
+    threads = [threading.Thread(target=worker, args=(16 // n_threads, ))
+               for i in range(n_threads)]
+    t0 = perf_counter()
+    for t in threads:
+        t.start()
+    while any(t.is_alive() for t in threads):
+        # Change extensions while the threads encode/decode
+        shared.remove_extension('c')
+        shared.add_extension(bsdf.ComplexExtension)
+        sleep(0.001)
+    t1 = perf_counter()
+    print('%i threads: %i ms, errors: %i' %
+          (n_threads, (t1 - t0) * 1000, len(errors)))
+
+
+# === Shared memory vs pipe: sending a large ndarray to another process
+
+import multiprocessing
+import numpy as np
+
+def pipe_receiver(conn):
+    a = bsdf.decode(conn.recv_bytes())[0]
+    conn.send(float(a[-1]))
+
+def shm_receiver(conn):
+    message = conn.recv()
+    with message:
+        a = message.load()[0]
+        conn.send(float(a[-1]))
+        del a
+
+print('-' * 10 + ' shared memory')
+a = np.random.normal(size=2**25)  # 256 MiB
+for name, receiver in [('pipe', pipe_receiver), ('shm', shm_receiver)]:
+    conn1, conn2 = multiprocessing.Pipe()
+    p = multiprocessing.Process(target=receiver, args=(conn2, ))
+    p.start()
+    t0 = perf_counter()
+    if name == 'pipe':
+        conn1.send_bytes(bsdf.encode([a]))
+        assert conn1.recv() == a[-1]
+    else:
+        message = bsdf.SharedMemoryMessage.create([a])
+        conn1.send(message)
+        assert conn1.recv() == a[-1]
+        message.close()
+        message.unlink()
+    t1 = perf_counter()
+    p.join()
+    print('%s: %i ms' % (name, (t1 - t0) * 1000))
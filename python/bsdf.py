@@ -23,15 +23,25 @@ Note: on Legacy Python (Python 2.7), non-Unicode strings are encoded as bytes.
 
 from __future__ import absolute_import, division, print_function
 
+import array
 import bz2
 import hashlib
 import logging
+import mmap
 import os
 import struct
 import sys
+import threading
+import time
 import types
 import zlib
-from io import BytesIO
+from collections import OrderedDict
+from io import BufferedRandom, BufferedReader, BytesIO, FileIO
+
+try:
+    import queue
+except ImportError:  # pragma: no cover - Legacy Python
+    import Queue as queue
 
 logger = logging.getLogger(__name__)
 
@@ -65,9 +75,46 @@ else:  # pragma: no cover
     integer_types = (int, long)  # noqa
     classtypes = type, types.ClassType
 
+# File types that buffer reads in C; other sources get a read-ahead buffer
+_buffered_file_types = (BytesIO, BufferedReader, BufferedRandom)
+if not PY3:  # pragma: no cover
+    _buffered_file_types += (file, )  # noqa
+
+# Typecode of int64 for array.array (there is no 'q' on Legacy Python)
+try:
+    array.array('q')
+    _INT64_TYPECODE = 'q'
+except ValueError:  # pragma: no cover - Legacy Python
+    _INT64_TYPECODE = 'l' if array.array('l').itemsize == 8 else None
+
+# Buffer types that can be written into blobs by patch(). When encoding, any
+# object that supports the buffer protocol is encoded as a blob (without
+# copying), unless an extension handles it.
+_buffer_types = (bytearray, memoryview, array.array, mmap.mmap)
+
 # Shorthands
 spack = struct.pack
 strunpack = struct.unpack
+strcalcsize = struct.calcsize
+
+# Type chars that patch() considers the same type, and names for messages
+_patch_types = {b'h': b'i', b'f': b'd', b'n': b'y'}
+_patch_type_names = {b'v': 'None', b'y': 'bool', b'i': 'int', b'd': 'float',
+                     b's': 'str', b'l': 'list', b'm': 'dict', b'b': 'bytes'}
+
+
+def _type_name(c, ext_id):
+    """ Get a name for the given (patch) type, for use in messages.
+    """
+    return ext_id or _patch_type_names.get(c, repr(c))
+
+
+# Extension id for references to out-of-band buffers
+_BUFFER_EXT_ID = 'bsdf.buffer'
+
+# Numeric type identifiers and their struct formats
+_numeric_formats = {b'h': '<h', b'i': '<q', b'f': '<f', b'd': '<d'}
+_numeric_types = (float, ) + ((int, ) if PY3 else (int, long))  # noqa
 
 
 def lencode(x):
@@ -125,6 +172,28 @@ class BsdfSerializer(object):
       compression.
     * use_checksum (bool): whether to include a checksum with binary blobs.
     * float64 (bool): Whether to write floats as 64 bit (default) or 32 bit.
+    * blob_reserve (float or str): extra space to allocate for blobs, so that
+      they can be grown in-place later (see `Blob.resize()`). Either a
+      fraction of the blob size (e.g. 0.5 for 50% extra), or "pow2" to round
+      the allocated size up to a power of two. Default 0.
+    * workers (int): if nonzero, a large list or mapping at the root of the
+      structure is split into segments that are encoded (and its blobs
+      compressed) in parallel, using this many worker processes. The result
+      is byte-identical to serial encoding. The values and extensions must
+      be picklable. On Linux, when no other threads are running, the workers
+      are forked and inherit the segments; otherwise, the workers are started
+      with the default method and the segments are pickled. Default 0.
+    * background_io (bool): if True, ``save()`` writes to the file in a
+      helper thread, while the encoder fills the next buffer, and ``load()``
+      reads ahead in a helper thread, while the decoder consumes the previous
+      buffer. This helps for slow disks and network file systems. Not used
+      for loading with ``lazy_blob`` or ``load_streaming``, since these keep
+      reading from the file after loading. Default False.
+    * vectored_io (bool): if True, ``save()`` collects the encoded chunks
+      (referring to the data of bytes and blobs, rather than copying it)
+      and writes them with ``os.writev()``, or ``sendmsg()`` if the target
+      is a socket, so that large payloads reach the kernel without being
+      copied. The result is byte-identical. Default False.
 
     Options for decoding:
 
@@ -133,20 +202,53 @@ class BsdfSerializer(object):
     * lazy_blob (bool): if True, bytes are represented as Blob objects that can
       be used to lazily access the data, and also overwrite the data if the
       file is open in a+ mode.
+    * numeric_lists (str): if "array" or "numpy", lists that contain only
+      numbers are decoded as ``array.array`` or numpy arrays (of int64
+      if all numbers are integers, float64 otherwise). Runs of same-typed
+      numbers are unpacked in bulk, which is much faster than decoding them
+      one by one. Default None.
+    * blob_cache (BlobCache): a cache for the contents of lazily loaded
+      blobs, which can be shared between serializers. Default None.
+
+    A serializer can be shared by multiple threads: encoding and decoding
+    keep their state on the stack, and extensions can be added and removed
+    while other threads use the serializer (each encode/decode call sees the
+    extensions from before or after the change). The objects being
+    encoded, and file objects, should not be shared between threads.
     """
 
+    # Per-call state for out-of-band buffers, set on a copy of the serializer
+    _buffer_callback = None
+    _buffers = None
+
     def __init__(self, extensions=None, **options):
+        # The extension dicts are replaced (not modified) on changes,
+        # so that threads can use them without locking.
         self._extensions = {}  # name -> extension
         self._extensions_by_cls = {}  # cls -> (name, extension.encode)
+        self._extensions_lock = threading.Lock()
         if extensions is None:
             extensions = standard_extensions
         for extension in extensions:
             self.add_extension(extension)
+        self._options = options
         self._parse_options(**options)
 
+    def __reduce__(self):
+        # Pickle by extension classes and options, e.g. to send to workers
+        classes = [e.__class__ for e in self._extensions.values()]
+        return self.__class__, (classes, ), {'_options': self._options}
+
+    def __setstate__(self, state):
+        self._options = state['_options']
+        self._parse_options(**self._options)
+
     def _parse_options(self,
                        compression=0, use_checksum=False, float64=True,
-                       load_streaming=False, lazy_blob=False):
+                       blob_reserve=0, workers=0, background_io=False,
+                       vectored_io=False,
+                       load_streaming=False, lazy_blob=False,
+                       numeric_lists=None, blob_cache=None):
 
         # Validate compression
         if isinstance(compression, string_types):
@@ -160,10 +262,28 @@ class BsdfSerializer(object):
         # Other encoding args
         self._use_checksum = bool(use_checksum)
         self._float64 = bool(float64)
+        if not (blob_reserve == 'pow2' or
+                isinstance(blob_reserve, (int, float)) and blob_reserve >= 0):
+            raise TypeError('blob_reserve must be a number >= 0 or "pow2"')
+        self._blob_reserve = blob_reserve
+        self._workers = int(workers or 0)
+        self._background_io = bool(background_io)
+        self._vectored_io = bool(vectored_io)
 
         # Decoding args
         self._load_streaming = bool(load_streaming)
         self._lazy_blob = bool(lazy_blob)
+        if numeric_lists not in (None, 'array', 'numpy'):
+            raise TypeError('numeric_lists must be None, "array" or "numpy"')
+        if numeric_lists == 'numpy':
+            import numpy  # noqa - fail early if numpy is not available
+        if numeric_lists == 'array' and _INT64_TYPECODE is None:
+            raise ValueError('numeric_lists="array" is not supported on '
+                             'this platform (array.array has no int64).')
+        self._numeric_lists = numeric_lists
+        if not (blob_cache is None or isinstance(blob_cache, BlobCache)):
+            raise TypeError('blob_cache must be a BlobCache or None.')
+        self._blob_cache = blob_cache
 
     def add_extension(self, extension_class):
         """ Add an extension to this serializer instance, which must be
@@ -199,9 +319,14 @@ class BsdfSerializer(object):
                 raise TypeError('Extension classes must be types.')
 
         # Store
-        for cls in clss:
-            self._extensions_by_cls[cls] = name, extension.encode
-        self._extensions[name] = extension
+        with self._extensions_lock:
+            extensions_by_cls = dict(self._extensions_by_cls)
+            for cls in clss:
+                extensions_by_cls[cls] = name, extension.encode
+            extensions = dict(self._extensions)
+            extensions[name] = extension
+            self._extensions_by_cls = extensions_by_cls
+            self._extensions = extensions
         return extension_class
 
     def remove_extension(self, name):
@@ -209,11 +334,14 @@ class BsdfSerializer(object):
         """
         if not isinstance(name, str):
             raise TypeError('Extension name must be str.')
-        if name in self._extensions:
-            self._extensions.pop(name)
-        for cls in list(self._extensions_by_cls.keys()):
-            if self._extensions_by_cls[cls][0] == name:
-                self._extensions_by_cls.pop(cls)
+        with self._extensions_lock:
+            extensions = dict(self._extensions)
+            extensions.pop(name, None)
+            extensions_by_cls = dict((cls, ex) for cls, ex in
+                                     self._extensions_by_cls.items()
+                                     if ex[0] != name)
+            self._extensions = extensions
+            self._extensions_by_cls = extensions_by_cls
 
     def _encode(self, f, value, streams, ext_id):
         """ Main encoder function.
@@ -253,11 +381,12 @@ class BsdfSerializer(object):
                 f.write(lencode(len(name_b)))
                 f.write(name_b)
                 self._encode(f, v, streams, None)
+        elif (self._buffer_callback is not None and ext_id is None and
+              isinstance(value, (bytes, Blob)) and
+              self._export_buffer(f, value)):
+            pass  # Written as a reference to an out-of-band buffer
         elif isinstance(value, bytes):
-            f.write(x(b'b', ext_id))  # B for blob
-            blob = Blob(value, compression=self._compression,
-                        use_checksum=self._use_checksum)
-            blob._to_file(f)  # noqa
+            self._encode_bytes(f, value, ext_id)
         elif isinstance(value, Blob):
             f.write(x(b'b', ext_id))  # B for blob
             value._to_file(f)  # noqa
@@ -313,9 +442,27 @@ class BsdfSerializer(object):
                 self._encode(f, extension_encode(self, value),
                              streams, ext_id2)
             else:
-                t = ('Class %r is not a valid base BSDF type, nor is it '
-                     'handled by an extension.')
-                raise TypeError(t % value.__class__.__name__)
+                # Maybe it supports the buffer protocol
+                try:
+                    view = _byte_view(value)
+                except TypeError:
+                    t = ('Class %r is not a valid base BSDF type, nor is it '
+                         'handled by an extension.')
+                    raise TypeError(t % value.__class__.__name__)
+                if not (self._buffer_callback is not None and
+                        self._export_buffer(f, value)):
+                    self._encode_bytes(f, view, None)
+
+    def _encode_bytes(self, f, value, ext_id):
+        """ Encode bytes (or a byte memoryview) as a blob.
+        """
+        f.write(encode_type_id(b'b', ext_id))  # B for blob
+        blob = Blob(value, compression=self._compression,
+                    use_checksum=self._use_checksum)
+        if self._blob_reserve:
+            blob.allocated_size = _reserve_size(blob.used_size,
+                                                self._blob_reserve)
+        blob._to_file(f)  # noqa
 
     def _decode(self, f):
         """ Main decoder function.
@@ -374,7 +521,10 @@ class BsdfSerializer(object):
             else:
                 # Normal
                 if n == 253: n = strunpack('<Q', f.read(8))[0]  # noqa
-                value = [self._decode(f) for i in range(n)]
+                if self._numeric_lists and ext_id is None and n > 0:
+                    value = self._decode_numeric_list(f, n)
+                else:
+                    value = [self._decode(f) for i in range(n)]
         elif c == b'm':
             value = dict()
             n = strunpack('<B', f.read(1))[0]
@@ -388,6 +538,7 @@ class BsdfSerializer(object):
         elif c == b'b':
             if self._lazy_blob:
                 value = Blob((f, True))
+                value._cache = self._blob_cache
             else:
                 blob = Blob((f, False))
                 value = blob.get_bytes()
@@ -399,21 +550,498 @@ class BsdfSerializer(object):
             extension = self._extensions.get(ext_id, None)
             if extension is not None:
                 value = extension.decode(self, value)
+            elif ext_id == _BUFFER_EXT_ID:
+                value = self._import_buffer(value)
             else:
                 logger.warn('BSDF warning: no extension found for %r' % ext_id)
 
         return value
 
-    def encode(self, ob):
+    def _export_buffer(self, f, value):
+        """ Offer the data of the given bytes, buffer or (uncompressed) Blob
+        to the buffer callback. Unless it returns True (i.e. keep the data
+        in-band), write a reference to the out-of-band buffer and return True.
+        """
+        if isinstance(value, Blob):
+            if (value._f is not None or value._source is not None or
+                    value.compression):
+                return False
+            value = value.compressed
+        if self._buffer_callback(value):
+            return False
+        f.write(encode_type_id(b'i', _BUFFER_EXT_ID) +
+                spack('<q', self._buffer_count))
+        self._buffer_count += 1
+        return True
+
+    def _import_buffer(self, index):
+        """ Get the out-of-band buffer with the given index.
+        """
+        if self._buffers is None:
+            raise ValueError('The data refers to out-of-band buffers, '
+                             'but no buffers were given.')
+        try:
+            return self._buffers[index]
+        except IndexError:
+            raise ValueError('The data refers to out-of-band buffer %i, '
+                             'but only %i buffers were given.' %
+                             (index, len(self._buffers)))
+
+    def _copy_for_call(self, **attributes):
+        """ Get a shallow copy of this serializer with the given attributes,
+        to hold state for a single encode/decode call (keeping this
+        serializer thread-safe).
+        """
+        s = object.__new__(self.__class__)
+        s.__dict__.update(self.__dict__)
+        s.__dict__.update(attributes)
+        return s
+
+    def _decode_numeric_list(self, f, n):
+        """ Decode a list of n elements, unpacking runs of numbers in bulk.
+        Returns an array if all elements are numbers, and a list otherwise.
+        """
+        runs = []  # (type char, tuple or ndarray)
+        i = 0
+        if _seekable(f):
+            while i < n:
+                c = f.read(1)
+                fmt = _numeric_formats.get(c, None)
+                if fmt is None:
+                    f.seek(-len(c), 1)
+                    break
+                # Read as if all remaining elements are of this type
+                stride = 1 + strcalcsize(fmt)
+                bb = c + f.read((n - i) * stride - 1)
+                type_chars = bb[::stride]
+                m = len(type_chars) - len(type_chars.lstrip(c))
+                if m * stride > len(bb):  # incomplete
+                    m -= 1
+                if m == 0:
+                    raise EOFError()
+                # Give back what we read too much
+                f.seek(m * stride - len(bb), 1)
+                bb = bb[:m * stride]
+                if self._numeric_lists == 'numpy':
+                    import numpy as np
+                    dtype = np.dtype([('t', 'u1'), ('v', fmt)])
+                    runs.append((c, np.frombuffer(bb, dtype)['v']))
+                else:
+                    runs.append((c, strunpack('<' + ('x' + fmt[1]) * m, bb)))
+                i += m
+
+        # Decode remaining elements as usual
+        if i < n:
+            value = []
+            for c, values in runs:
+                value.extend(values if isinstance(values, tuple)
+                             else values.tolist())
+            value.extend(self._decode(f) for i in range(n - i))
+            if not all(type(v) in _numeric_types for v in value):
+                return value
+            is_int = all(isinstance(v, integer_types) for v in value)
+            runs = [(b'i' if is_int else b'd', value)]
+
+        # Produce array
+        is_int = all(c in b'hi' for c, values in runs)
+        if self._numeric_lists == 'numpy':
+            import numpy as np
+            dtype = np.int64 if is_int else np.float64
+            return np.concatenate([np.asarray(values, dtype)
+                                   for c, values in runs])
+        else:
+            value = array.array(_INT64_TYPECODE if is_int else 'd')
+            for c, values in runs:
+                value.extend(values)
+            return value
+
+    def _skip(self, f, seekable=None):
+        """ Skip over the next value in the file, without decoding it.
+        Payloads of large strings and blobs are seeked over if the file is
+        seekable (which is determined once if not given).
+        """
+        if seekable is None:
+            seekable = _seekable(f)
+        char = f.read(1)
+        c = char.lower()
+        if char != c:
+            n = strunpack('<B', f.read(1))[0]
+            f.read(n)
+
+        n = _SCALAR_SIZES.get(c, -1)
+        if n > 0:
+            if len(f.read(n)) < n:
+                raise EOFError()
+        elif n == 0:
+            pass
+        elif c == b's':
+            n = strunpack('<B', f.read(1))[0]
+            if n == 253: n = strunpack('<Q', f.read(8))[0]  # noqa
+            if seekable and n > _SKIP_SEEK_SIZE:
+                f.seek(n, 1)
+            elif len(f.read(n)) < n:
+                raise EOFError()
+        elif c == b'l':
+            n = strunpack('<B', f.read(1))[0]
+            if n >= 254:
+                closed = n == 254
+                n = strunpack('<Q', f.read(8))[0]
+                if not closed:
+                    try:
+                        while True:
+                            self._skip(f, seekable)
+                    except EOFError:
+                        pass
+                    n = 0
+            elif n == 253:
+                n = strunpack('<Q', f.read(8))[0]
+            for i in range(n):
+                self._skip(f, seekable)
+        elif c == b'm':
+            for i in range(lendecode(f)):
+                _skip_bytes(f, lendecode(f), seekable)
+                self._skip(f, seekable)
+        elif c == b'b':
+            Blob((f, seekable))
+        elif not char:
+            raise EOFError()
+        else:
+            raise RuntimeError('Parse error %r' % char)
+
+    def _seek_key_path(self, f, key_path):
+        """ Move the file pointer to the value at the given key path, by
+        skipping over the values that are not on the path. The file must
+        be positioned at the start of the value to search in.
+        """
+        if isinstance(key_path, (string_types, integer_types)):
+            key_path = [key_path]
+        for key in key_path:
+            char = f.read(1)
+            c = char.lower()
+            if char != c:
+                f.read(strunpack('<B', f.read(1))[0])
+            if c == b'm':
+                if not isinstance(key, string_types):
+                    raise TypeError('Mapping key must be str, not %r' % key)
+                for i in range(lendecode(f)):
+                    name = f.read(lendecode(f)).decode('UTF-8')
+                    if name == key:
+                        break
+                    self._skip(f)
+                else:
+                    raise KeyError(key)
+            elif c == b'l':
+                if not isinstance(key, integer_types):
+                    raise TypeError('List index must be int, not %r' % key)
+                n = strunpack('<B', f.read(1))[0]
+                if n >= 254:
+                    closed = n == 254
+                    n = strunpack('<Q', f.read(8))[0]
+                    n = n if closed else -1
+                elif n == 253:
+                    n = strunpack('<Q', f.read(8))[0]
+                if key < 0 and n >= 0:
+                    key += n
+                if key < 0 or (n >= 0 and key >= n):
+                    raise IndexError('List index out of range')
+                try:
+                    for i in range(key):
+                        self._skip(f)
+                    # Check that the item exists (in unclosed streams)
+                    i = f.tell()
+                    if not f.read(1):
+                        raise EOFError()
+                    f.seek(i)
+                except EOFError:
+                    raise IndexError('List index out of range')
+            else:
+                raise TypeError('Cannot index into value of type %r' % char)
+
+    def patch(self, f, key_path, value, convert=False):
+        """ Overwrite the value at the given key path (a list of keys and
+        indices) in the BSDF file object (opened in 'r+b' mode), without
+        rewriting the rest of the file. This only works if the new value
+        encodes to the same number of bytes as the old value, e.g. for
+        changing scalars or equal-length strings. Integers are encoded to
+        fit in an integer slot, and floats in a float slot, if possible.
+        Bytes can be patched into an uncompressed blob if they fit in its
+        allocated size, and an ndarray can be patched with an array of the
+        same shape and dtype if its data is not compressed. Checksums of
+        patched blobs are updated as well.
+
+        The new value must be of the same type as the old value (e.g. an int
+        for an int, and bytes for a blob), unless ``convert`` is True, in
+        which case e.g. an int slot can hold a float (or None) afterwards.
+        """
+        self._check_header(f)
+        self._seek_key_path(f, key_path)
+        pos = f.tell()
+        char = f.read(1)
+        c = char.lower()
+        ext_id = None
+        if char != c:
+            ext_id = f.read(strunpack('<B', f.read(1))[0]).decode('UTF-8')
+
+        if ext_id == 'ndarray' and hasattr(value, 'shape'):
+            # Write the array data into the blob
+            import numpy as np
+            f.seek(pos)
+            shape, dtype, blob = self._read_ndarray_header(f)
+            if (tuple(value.shape) != shape or
+                    np.dtype(value.dtype) != np.dtype(dtype)):
+                raise ValueError('Can only patch an ndarray with an array of '
+                                 'the same shape and dtype.')
+            if blob.compression:
+                raise ValueError('Cannot patch a compressed ndarray.')
+            blob.seek(0)
+            blob.write(np.ascontiguousarray(value).reshape(-1).view(np.uint8))
+            blob.update_checksum()
+            return
+
+        if c == b'b' and isinstance(value, (bytes, ) + _buffer_types):
+            # Write into the blob
+            value = _byte_view(value)
+            blob = Blob((f, True))
+            blob._cache = self._blob_cache
+            if blob.compression:
+                raise ValueError('Cannot patch a compressed blob.')
+            if len(value) > blob.allocated_size:
+                raise ValueError('Bytes do not fit in the blob.')
+            blob.resize(len(value))
+            blob.seek(0)
+            blob.write(value)
+            blob.update_checksum()
+            return
+
+        f.seek(pos)
+        self._skip(f)
+        n_old = f.tell() - pos
+
+        # Encode the value, taking the type of the current slot into account
+        x = encode_type_id
+        if c in (b'i', b'd') and type(value) in _numeric_types:
+            if c == b'i' and isinstance(value, integer_types):
+                bb = x(b'i', ext_id) + spack('<q', value)
+            else:
+                bb = x(b'd', ext_id) + spack('<d', value)
+        elif isinstance(value, float) and c == b'f':
+            bb = x(b'f', ext_id) + spack('<f', value)
+        else:
+            f2 = BytesIO()
+            streams = []
+            self._encode(f2, value, streams, None)
+            if streams:
+                raise ValueError('Cannot patch a stream into a file.')
+            bb = f2.getvalue()
+
+        # Check the type, e.g. bytes (a blob) for a str is not the same,
+        # and neither is an int for a float (even if encoded as a float)
+        new_char = bb[0:1]
+        new_ext_id = None
+        if new_char != new_char.lower():
+            n = strunpack('<B', bb[1:2])[0]
+            new_ext_id = bb[2:2 + n].decode('UTF-8')
+            new_char = new_char.lower()
+        if type(value) in _numeric_types:
+            new_char = b'i' if isinstance(value, integer_types) else b'd'
+        old_type = _patch_types.get(c, c), ext_id
+        new_type = _patch_types.get(new_char, new_char), new_ext_id
+        if new_type != old_type and not convert:
+            raise ValueError('Cannot patch a value of type %r with a value '
+                             'of type %r (unless convert is True).' %
+                             (_type_name(*old_type), _type_name(*new_type)))
+
+        if len(bb) != n_old:
+            raise ValueError('Cannot patch a value of %i bytes with a value '
+                             'of %i bytes.' % (n_old, len(bb)))
+        f.seek(pos)
+        f.write(bb)
+
+    def open_stream_for_append(self, f):
+        """ Get the stream at the end of the structure in the given file
+        object (opened in 'r+b' mode) as a ListStream in write mode, so that
+        more items can be appended to it. Earlier items are skipped over
+        (not decoded), and an incomplete item at the end of the file (e.g.
+        due to a crash) is truncated. All complete items are kept, also those
+        appended after the stream was closed; the stream is marked as
+        unclosed again (until it is closed).
+        """
+        self._check_header(f)
+        # Find the stream, skipping all but the last object in containers
+        while True:
+            char = f.read(1)
+            c = char.lower()
+            if char != c:
+                f.read(strunpack('<B', f.read(1))[0])
+            if c == b'l':
+                n = strunpack('<B', f.read(1))[0]
+                if n >= 254:
+                    break
+                elif n == 253:
+                    n = strunpack('<Q', f.read(8))[0]
+            elif c == b'm':
+                n = lendecode(f)
+            else:
+                n = 0
+            if n == 0:
+                raise ValueError('The file does not end with a stream.')
+            for i in range(n - 1):
+                if c == b'm':
+                    _skip_bytes(f, lendecode(f), True)
+                self._skip(f, True)
+            if c == b'm':
+                _skip_bytes(f, lendecode(f), True)
+
+        # Skip the items included in the count in the header; these are
+        # complete, unless e.g. the count was written before the items
+        header_pos = f.tell() - 1
+        start_pos = header_pos + 9
+        count = strunpack('<Q', f.read(8))[0]
+        f.seek(0, 2)
+        file_size = f.tell()
+        f.seek(start_pos)
+        try:
+            for i in range(count):
+                self._skip(f, True)
+            pos = f.tell()
+        except (EOFError, RuntimeError, struct.error):
+            pos = file_size + 1
+        if pos > file_size:
+            f.seek(start_pos)
+            pos, count = start_pos, 0
+
+        # Count the complete items that follow
+        try:
+            while pos < file_size:
+                self._skip(f, True)
+                end = f.tell()
+                if end > file_size:
+                    break  # incomplete item (seeked beyond the end)
+                pos, count = end, count + 1
+        except (EOFError, RuntimeError, struct.error):
+            pass  # incomplete or invalid item
+        if pos < file_size:
+            logger.warning('BSDF warning: truncating incomplete stream item.')
+            f.seek(pos)
+            f.truncate()
+
+        # Mark stream as unclosed, and create the stream object
+        f.seek(header_pos)
+        f.write(spack('<BQ', 255, count))
+        f.seek(pos)
+        stream = ListStream('w')
+        stream._activate(f, self._encode, self._decode)
+        stream._start_pos = header_pos + 9
+        stream._i = stream._count = count
+        return stream
+
+    def _read_ndarray_header(self, f):
+        """ Read an ndarray extension value, giving its shape, dtype, and the
+        blob that holds its data. The blob is not loaded.
+        """
+        char = f.read(1)
+        ext_id = None
+        if char == b'M':
+            ext_id = f.read(strunpack('<B', f.read(1))[0]).decode('UTF-8')
+        if ext_id != 'ndarray':
+            raise TypeError('The value at the key path is not an ndarray.')
+        shape = dtype = blob = None
+        for i in range(lendecode(f)):
+            name = f.read(lendecode(f)).decode('UTF-8')
+            if name == 'data':
+                if f.read(1) != b'b':
+                    raise ValueError('Invalid ndarray value.')
+                blob = Blob((f, True))
+                blob._cache = self._blob_cache
+            elif name in ('shape', 'dtype'):
+                value = self._decode(f)
+                if name == 'shape':
+                    shape = tuple(int(i) for i in value)
+                else:
+                    dtype = value
+            else:
+                self._skip(f)
+        if shape is None or dtype is None or blob is None:
+            raise ValueError('Invalid ndarray value.')
+        return shape, dtype, blob
+
+    def memmap(self, filename, key_path, mode='r+'):
+        """ Get a numpy memmap for the ndarray at the given key path (a list
+        of keys and indices) in the given file, so that it can be read and
+        modified in-place. The array data must not be compressed.
+        Arrays with a checksum can only be mapped in read-only mode.
+        """
+        import numpy as np
+        with open(filename, 'rb') as f:
+            self._check_header(f)
+            self._seek_key_path(f, key_path)
+            shape, dtype, blob = self._read_ndarray_header(f)
+        if blob.compression:
+            raise ValueError('Cannot memmap a compressed ndarray.')
+        if blob.use_checksum and mode != 'r':
+            raise ValueError('Cannot memmap an ndarray with a checksum in '
+                             'write mode; use patch() instead.')
+        return np.memmap(filename, dtype, mode, blob.start_pos, shape)
+
+    def encode(self, ob, buffer_callback=None):
         """ Save the given object to bytes.
+
+        If ``buffer_callback`` is given, it is called with the data of each
+        bytes object and uncompressed Blob (in order). Unless it returns
+        True, the data is not written, but replaced by a reference to
+        an out-of-band buffer, e.g. to send the data via another channel.
+        Pass the buffers to ``decode()`` (in the same order) to decode.
         """
         f = BytesIO()
-        self.save(f, ob)
+        if buffer_callback is None:
+            self.save(f, ob)
+        else:
+            s = self._copy_for_call(_buffer_callback=buffer_callback,
+                                    _buffer_count=0)
+            s.save(f, ob)
         return f.getvalue()
 
     def save(self, f, ob):
-        """ Write the given object to the given file object.
+        """ Write the given object to the given file object (or socket,
+        with the ``vectored_io`` option).
+        """
+        if self._vectored_io:
+            self._save_vectored(f, ob)
+        elif self._background_io:
+            f2 = _WriteBehindFile(f, _BACKGROUND_IO_CHUNK_SIZE)
+            try:
+                self._save(f2, ob)
+            finally:
+                f2.close()
+            # Streams continue on the real file
+            for stream in f2.streams:
+                stream._f = f
+        else:
+            self._save(f, ob)
+
+    def _save_vectored(self, f, ob):
+        """ Encode to chunks, and write these with a minimal number of
+        system calls (scatter-gather output).
         """
+        if hasattr(f, 'sendmsg'):
+            start = 0  # a socket
+        else:
+            if hasattr(f, 'flush'):
+                f.flush()  # we write to the file descriptor directly
+            try:
+                start = f.tell()
+            except Exception:
+                start = 0  # tell() is not supported
+        f2 = _ChunkFile(start)
+        self._save(f2, ob)
+        if f2.streams and hasattr(f, 'sendmsg'):
+            raise ValueError('Cannot write a stream directly to a socket.')
+        _write_vectored(f, f2.chunks)
+        # Streams continue on the real file
+        for stream in f2.streams:
+            stream._f = f
+
+    def _save(self, f, ob):
         f.write(b'BSDF')
         f.write(struct.pack('<B', VERSION[0]))
         f.write(struct.pack('<B', VERSION[1]))
@@ -421,7 +1049,12 @@ class BsdfSerializer(object):
         # Prepare streaming, this list will have 0 or 1 item at the end
         streams = []
 
-        self._encode(f, ob, streams, None)
+        if (self._workers and isinstance(ob, (list, tuple, dict)) and
+                len(ob) >= 2 * _PARALLEL_SEGMENT_SIZE and
+                self._buffer_callback is None):
+            self._encode_parallel(f, ob, streams)
+        else:
+            self._encode(f, ob, streams, None)
 
         # Verify that stream object was at the end, and add initial elements
         if len(streams) > 0:
@@ -429,16 +1062,116 @@ class BsdfSerializer(object):
             if stream._start_pos != f.tell():
                 raise ValueError('The stream object must be '
                                  'the last object to be encoded.')
+            if isinstance(f, (_WriteBehindFile, _ChunkFile)):
+                f.streams.append(stream)
+
+    def _encode_parallel(self, f, value, streams):
+        """ Encode a list or mapping by encoding segments of it in parallel.
+        """
+        is_dict = isinstance(value, dict)
+        items = list(value.items()) if is_dict else list(value)
+        f.write((b'm' if is_dict else b'l') + lencode(len(items)))
+        # A stream must be encoded here, and is always the last item
+        last = items[-1][1] if is_dict else items[-1]
+        tail = items[-1:] if isinstance(last, BaseStream) else []
+        items = items[:len(items) - len(tail)]
+        for v in items:
+            if isinstance(v[1] if is_dict else v, BaseStream):
+                raise ValueError('The stream object must be '
+                                 'the last object to be encoded.')
+
+        import multiprocessing
+        n_segments = min(self._workers * 4,
+                         len(items) // _PARALLEL_SEGMENT_SIZE)
+        bounds = [len(items) * i // n_segments for i in range(n_segments + 1)]
+        segments = [(self, items[i1:i2], is_dict)
+                    for i1, i2 in zip(bounds[:-1], bounds[1:])]
+        # Forked workers inherit the segments, so they need not be pickled.
+        # But forking is only safe if no other threads run (which may hold
+        # locks), and is not reliable on other platforms than Linux.
+        ctx = None
+        if (sys.platform.startswith('linux') and
+                threading.active_count() == 1):
+            try:
+                ctx = multiprocessing.get_context('fork')
+            except AttributeError:  # pragma: no cover - Legacy Python
+                ctx = multiprocessing
+        if ctx is None:
+            ctx, tasks = multiprocessing, segments
+        else:
+            key = id(segments)
+            _parallel_segments[key] = segments
+            tasks = [(key, i) for i in range(len(segments))]
+        try:
+            pool = ctx.Pool(self._workers)
+        finally:
+            _parallel_segments.pop(id(segments), None)
+        try:
+            results = pool.imap(_encode_segment, tasks)
+            for bb, alignment_pos in results:
+                # Blob alignment depends on the position in the file
+                f.write(_realign(bb, alignment_pos, f.tell()))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        self._encode_items(f, tail, is_dict, streams)
+
+    def _encode_items(self, f, items, is_dict, streams):
+        """ Encode the given items of a list, or (key, value) items of a dict.
+        """
+        for v in items:
+            if is_dict:
+                key, v = v
+                name_b = key.encode('UTF-8')
+                f.write(lencode(len(name_b)))
+                f.write(name_b)
+            self._encode(f, v, streams, None)
 
-    def decode(self, bb):
+    def decode(self, bb, buffers=None):
         """ Load the data structure that is BSDF-encoded in the given bytes.
+        If the data was encoded with a ``buffer_callback``, the out-of-band
+        buffers must be given as a sequence. They are returned (without
+        copying) in the place of the bytes objects that they replaced.
         """
         f = BytesIO(bb)
-        return self.load(f)
+        if buffers is None:
+            return self.load(f)
+        s = self._copy_for_call(_buffers=list(buffers))
+        return s.load(f)
 
     def load(self, f):
         """ Load a BSDF-encoded object from the given file object.
+        Unbuffered seekable file objects are read in large chunks, and are
+        afterwards positioned at the end of the document. Other unbuffered
+        file objects (e.g. sockets and pipes) are read only as far as needed,
+        so that a next document can be loaded from them; wrap these in an
+        ``io.BufferedReader`` to read them in large chunks.
+        """
+        f = self._wrap_for_reading(f)
+        try:
+            self._check_header(f)
+            return self._decode(f)
+        finally:
+            if isinstance(f, _ReadAheadFile):
+                f.close()
+
+    def _wrap_for_reading(self, f):
+        """ Wrap the given file object to read ahead (in large chunks) if it
+        is not buffered and can give back unconsumed data by seeking, or to
+        read in the background.
         """
+        if self._lazy_blob or self._load_streaming:
+            return f  # the file is used after loading
+        elif isinstance(f, (_ReadAheadFile, _PooledFile, _MemoryFile)):
+            return f
+        elif self._background_io:
+            return _PrefetchFile(f, _BACKGROUND_IO_CHUNK_SIZE)
+        elif not isinstance(f, _buffered_file_types) and _seekable(f):
+            return _ReadAheadFile(f, _READ_AHEAD_SIZE)
+        return f
+
+    def _check_header(self, f):
         # Check magic string
         f4 = f.read(4)
         if f4 != b'BSDF':
@@ -446,17 +1179,541 @@ class BsdfSerializer(object):
         # Check version
         major_version = strunpack('<B', f.read(1))[0]
         minor_version = strunpack('<B', f.read(1))[0]
-        file_version = '%i.%i' % (major_version, minor_version)
-        if major_version != VERSION[0]:  # major version should be 2
-            t = ('Reading file with different major version (%s) '
-                 'from the implementation (%s).')
-            raise RuntimeError(t % (file_version, __version__))
-        if minor_version > VERSION[1]:  # minor should be < ours
-            t = ('BSDF warning: reading file with higher minor version (%s) '
-                 'than the implementation (%s).')
-            logger.warn(t % (file_version, __version__))
+        _check_version(major_version, minor_version)
+
+    def save_all(self, f, obs, length_prefix=False):
+        """ Write the objects from the given iterable to the given file
+        object, as a sequence of BSDF documents. If ``length_prefix`` is True,
+        each document is preceded by its size in bytes (as a little endian
+        uint64), so that readers can skip documents without decoding them.
+        The objects cannot contain streams.
+        """
+        for ob in obs:
+            if not length_prefix:
+                self._save_document(f, ob)
+            elif _seekable(f):
+                # Write the document, then backpatch its size
+                i0 = f.tell()
+                f.write(spack('<Q', 0))
+                self._save_document(f, ob)
+                i1 = f.tell()
+                f.seek(i0)
+                f.write(spack('<Q', i1 - i0 - 8))
+                f.seek(i1)
+            else:
+                # Encode for the real position, blob alignment depends on it
+                try:
+                    start = f.tell() + 8
+                except Exception:
+                    start = 8  # tell() is not supported
+                f2 = _OffsetFile(start)
+                self._save_document(f2, ob)
+                bb = f2.getvalue()
+                f.write(spack('<Q', len(bb)))
+                f.write(bb)
+
+    def _save_document(self, f, ob):
+        streams = []
+        f.write(b'BSDF')
+        f.write(spack('<BB', VERSION[0], VERSION[1]))
+        self._encode(f, ob, streams, None)
+        if streams:
+            raise ValueError('Cannot use streams with save_all().')
+
+    def load_all(self, f, length_prefix=False, skip=None):
+        """ Lazily load a sequence of BSDF documents from the given file
+        object, as written by ``save_all()``. Returns a generator. If given,
+        ``skip`` is a function that gets the index of each document, and
+        returns True if that document should be skipped. Skipped documents
+        are not decoded, and with ``length_prefix`` not even parsed.
+        """
+        f = self._wrap_for_reading(f)
+        try:
+            for ob in self._load_all(f, length_prefix, skip):
+                yield ob
+        finally:
+            if isinstance(f, _ReadAheadFile):
+                f.close()
+
+    def _load_all(self, f, length_prefix, skip):
+        index = -1
+        while True:
+            index += 1
+            if length_prefix:
+                prefix = f.read(8)
+                if not prefix:
+                    return
+                elif len(prefix) < 8:
+                    raise EOFError('Unexpected end of BSDF frame prefix.')
+                n = strunpack('<Q', prefix)[0]
+                if skip is not None and skip(index):
+                    _skip_bytes(f, n)
+                elif _seekable(f):
+                    i = f.tell()
+                    ob = self.load(f)
+                    f.seek(i + n)
+                    yield ob
+                else:
+                    yield self.load(BytesIO(f.read(n)))
+            else:
+                f4 = f.read(4)
+                if not f4:
+                    return
+                elif f4 != b'BSDF':
+                    raise RuntimeError('This does not look like a '
+                                       'BSDF file: %r' % f4)
+                _check_version(*strunpack('<BB', f.read(2)))
+                if skip is not None and skip(index):
+                    self._skip(f)
+                else:
+                    yield self._decode(f)
+
+
+def _check_version(major_version, minor_version):
+    """ Check the version of a file being read against our version.
+    """
+    file_version = '%i.%i' % (major_version, minor_version)
+    if major_version != VERSION[0]:  # major version should be 2
+        t = ('Reading file with different major version (%s) '
+             'from the implementation (%s).')
+        raise RuntimeError(t % (file_version, __version__))
+    if minor_version > VERSION[1]:  # minor should be < ours
+        t = ('BSDF warning: reading file with higher minor version (%s) '
+             'than the implementation (%s).')
+        logger.warn(t % (file_version, __version__))
+
+
+# The minimum number of items of a segment to encode in parallel
+_PARALLEL_SEGMENT_SIZE = 1000
+
+
+class _SegmentFile(BytesIO):
+    """ A BytesIO to encode data that is written at a position that is not
+    known yet. It records the position of the first blob alignment, so that
+    the data can be realigned with `_realign()` once the position is known.
+    """
+
+    alignment_pos = None
+
+
+def _realign(bb, alignment_pos, offset):
+    """ Get the bytes of a segment (see `_SegmentFile`) aligned for writing
+    at the given offset. Only the padding of the first aligned blob needs
+    to change; the data after it shifts by a multiple of 8 bytes.
+    """
+    if alignment_pos is None:
+        return bb
+    p = alignment_pos
+    old = strunpack('<B', bb[p:p + 1])[0]
+    new = 8 - (offset + p + 1) % 8
+    if new == old:
+        return bb
+    return bb[:p] + spack('<B', new) + b'\x00' * new + bb[p + 1 + old:]
+
+
+class _OffsetFile(BytesIO):
+    """ A BytesIO that reports positions as if its data starts at the given
+    offset in a file.
+    """
+
+    def __init__(self, offset):
+        BytesIO.__init__(self)
+        self._offset = offset
+
+    def tell(self):
+        return self._offset + BytesIO.tell(self)
+
+
+# Segments to encode, to be inherited by forked worker processes
+_parallel_segments = {}
+
 
-        return self._decode(f)
+def _encode_segment(task):
+    """ Encode a segment of list or dict items. Used by worker processes.
+    """
+    if len(task) == 2:
+        key, i = task
+        task = _parallel_segments[key][i]
+    serializer, items, is_dict = task
+    f = _SegmentFile()
+    streams = []
+    serializer._encode_items(f, items, is_dict, streams)
+    if streams:
+        raise ValueError('The stream object must be '
+                         'the last object to be encoded.')
+    return f.getvalue(), f.alignment_pos
+
+
+# The size of the buffers that are written or read in a helper thread
+_BACKGROUND_IO_CHUNK_SIZE = 2 ** 20
+
+# The time to wait for a read to finish when closing a prefetching reader
+_PREFETCH_CLOSE_TIMEOUT = 1.0
+
+
+class _WriteBehindFile(object):
+    """ File wrapper that collects written bytes in buffers, which are
+    written to the real file by a helper thread. At most two full buffers
+    wait to be written, bounding memory use. Call close() to write the
+    remaining data; this does not close the real file.
+    """
+
+    def __init__(self, f, chunk_size):
+        self._f = f
+        self._chunk_size = chunk_size
+        try:
+            self._pos = f.tell()
+        except Exception:
+            self._pos = None  # tell() is not supported
+        self._buffer = bytearray()
+        self._error = None
+        self.streams = []
+        self._queue = queue.Queue(2)
+        self._thread = threading.Thread(target=self._write_chunks,
+                                        name='BSDF writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_chunks(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            try:
+                if self._error is None:
+                    self._f.write(chunk)
+            except Exception as err:
+                self._error = err
+
+    def _put(self, chunk):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(chunk)
+
+    def write(self, bb):
+        self._buffer += bb
+        if len(self._buffer) >= self._chunk_size:
+            chunk, self._buffer = bytes(self._buffer), bytearray()
+            if self._pos is not None:
+                self._pos += len(chunk)
+            self._put(chunk)
+
+    def tell(self):
+        if self._pos is None:
+            raise IOError('The file does not support tell().')
+        return self._pos + len(self._buffer)
+
+    def close(self):
+        if self._thread is None:
+            return
+        try:
+            if self._buffer:
+                self._put(bytes(self._buffer))
+                self._buffer = bytearray()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            raise self._error
+
+
+# The size of the chunks to read from unbuffered files
+_READ_AHEAD_SIZE = 2 ** 16
+
+
+class _ReadAheadFile(object):
+    """ File wrapper that reads from the real file in large chunks, so that
+    the many small reads of the decoder are served from a local buffer.
+    Call close() to move the real file (if seekable) to the position up to
+    which data was consumed; this does not close the real file.
+    """
+
+    def __init__(self, f, chunk_size):
+        self._f = f
+        self._chunk_size = chunk_size
+        try:
+            self._buffer_start = f.tell()  # position of the buffer in file
+        except Exception:
+            self._buffer_start = None  # tell() is not supported
+        self._buffer = b''
+        self._buffer_pos = 0
+
+    def _next_chunk(self):
+        return self._f.read(self._chunk_size)
+
+    def read(self, n):
+        i = self._buffer_pos
+        j = i + n
+        if j <= len(self._buffer):
+            self._buffer_pos = j
+            return self._buffer[i:j]
+        # Collect data from the buffer and new chunks
+        parts = [self._buffer[i:]]
+        n -= len(parts[0])
+        while n > 0:
+            self._set_buffer(self._next_chunk())
+            if len(self._buffer) >= n:
+                parts.append(self._buffer[:n])
+                self._buffer_pos = n
+                break
+            parts.append(self._buffer)
+            n -= len(self._buffer)
+            self._buffer_pos = len(self._buffer)
+            if not self._buffer:
+                break  # EOF
+        return b''.join(parts)
+
+    def _set_buffer(self, chunk):
+        if self._buffer_start is not None:
+            self._buffer_start += len(self._buffer)
+        self._buffer, self._buffer_pos = chunk, 0
+
+    def tell(self):
+        if self._buffer_start is None:
+            raise IOError('The file does not support tell().')
+        return self._buffer_start + self._buffer_pos
+
+    def seekable(self):
+        return self._buffer_start is not None and _seekable(self._f)
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.tell()
+        elif whence != 0:
+            raise IOError('Can only seek relative to start or current pos.')
+        i = pos - self._buffer_start
+        if 0 <= i <= len(self._buffer):
+            self._buffer_pos = i
+        else:
+            self._f.seek(pos)
+            self._buffer_start, self._buffer, self._buffer_pos = pos, b'', 0
+        return pos
+
+    def close(self):
+        if self.seekable():
+            self._f.seek(self.tell())
+
+
+class _PrefetchFile(_ReadAheadFile):
+    """ File wrapper that reads chunks from the real file in a helper thread,
+    ahead of the reads of the decoder. At most two chunks are read ahead. Call
+    close() to stop the helper thread; this moves the real file (if seekable)
+    to the position up to which data was consumed, but does not close it.
+    For other files (e.g. sockets and pipes), close() does not wait for a
+    read that blocks (longer than a timeout); the data of that read is lost.
+    """
+
+    def __init__(self, f, chunk_size):
+        _ReadAheadFile.__init__(self, f, chunk_size)
+        self._seekable = _seekable(f)
+        self._eof = False
+        self._error = None
+        self._stop = False
+        self._queue = queue.Queue(2)
+        self._thread = threading.Thread(target=self._read_chunks,
+                                        name='BSDF reader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_chunks(self):
+        while not self._stop:
+            try:
+                chunk = self._f.read(self._chunk_size)
+            except Exception as err:
+                self._error = err
+                chunk = b''
+            while not self._stop:
+                try:
+                    self._queue.put(chunk, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if not chunk:
+                return
+
+    def _next_chunk(self):
+        if self._eof:
+            return b''
+        chunk = self._queue.get()
+        if not chunk:
+            self._eof = True
+            if self._error is not None:
+                raise self._error
+        return chunk
+
+    def seekable(self):
+        return False  # the helper thread moves the real file
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop = True
+        if self._seekable:
+            self._thread.join()
+        else:
+            # The (daemon) thread stops after a read that may block forever
+            self._thread.join(_PREFETCH_CLOSE_TIMEOUT)
+        self._thread = None
+        if self._buffer_start is not None and self._seekable:
+            self._f.seek(self.tell())
+
+
+def _reserve_size(n, reserve):
+    """ Get the size to allocate for n bytes, given a growth reserve policy.
+    """
+    if reserve == 'pow2':
+        return 1 << max(0, n - 1).bit_length()
+    else:
+        return n + int(n * reserve)
+
+
+def _fsync(f):
+    """ Flush the given file to disk, if it's a real file.
+    """
+    try:
+        fd = f.fileno()
+    except (AttributeError, IOError, ValueError):
+        return
+    os.fsync(fd)
+
+
+def _write_all(f, bb):
+    """ Write all given bytes to an unbuffered file.
+    """
+    view = memoryview(bb)
+    while len(view):
+        n = f.write(view)
+        view = view[n:]
+
+
+# Chunks smaller than this are joined before writing them vectored
+_VECTORED_MIN_CHUNK_SIZE = 2 ** 12
+
+
+def _write_vectored(f, chunks):
+    """ Write the given chunks to a file with ``os.writev()``, or to a socket
+    with ``sendmsg()``. Small chunks are joined, large chunks are passed
+    as-is. Falls back to write() for file objects without a file descriptor.
+    """
+    # Join runs of small chunks
+    buffers, small = [], []
+    for bb in chunks:
+        if len(bb) < _VECTORED_MIN_CHUNK_SIZE:
+            small.append(bb)
+        else:
+            if small:
+                buffers.append(b''.join(small))
+                small = []
+            buffers.append(bb)
+    if small:
+        buffers.append(b''.join(small))
+    # Select how to write
+    fd = None
+    if hasattr(f, 'sendmsg'):
+        write_buffers = f.sendmsg
+    else:
+        try:
+            fd = f.fileno() if hasattr(os, 'writev') else None
+        except (AttributeError, IOError, ValueError):
+            pass
+        if fd is None:
+            for bb in buffers:
+                f.write(bb)
+            return
+
+        def write_buffers(bufs):
+            return os.writev(fd, bufs)
+    try:
+        iov_max = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):  # pragma: no cover
+        iov_max = 16  # the POSIX minimum
+    # Write, handling partial writes
+    buffers = [memoryview(bb) for bb in buffers]
+    i = 0
+    while i < len(buffers):
+        n = write_buffers(buffers[i:i + iov_max])
+        while i < len(buffers) and n >= len(buffers[i]):
+            n -= len(buffers[i])
+            i += 1
+        if n:
+            buffers[i] = buffers[i][n:]
+    # Let a buffered file object know its new position
+    if fd is not None and _seekable(f):
+        f.seek(os.lseek(fd, 0, os.SEEK_CUR))
+
+
+def _write_padding(f, n):
+    """ Write n zero bytes to the given file. On real files, large paddings
+    at the end of the file are skipped by seeking, making the file sparse
+    (on file systems that support it).
+    """
+    if n >= 2 ** 16 and hasattr(f, 'fileno') and _seekable(f):
+        try:
+            at_end = os.fstat(f.fileno()).st_size <= f.tell()
+        except (IOError, OSError):  # pragma: no cover
+            at_end = False
+        if at_end:
+            f.seek(n - 1, 1)
+            f.write(b'\x00')
+            return
+    while n > 0:
+        f.write(b'\x00' * min(n, 2 ** 20))
+        n -= 2 ** 20
+
+
+def _byte_view(value):
+    """ Get a flat memoryview of bytes for the given object that supports
+    the buffer protocol (without copying the data). Raises TypeError if the
+    object does not support it, and ValueError if it is not C-contiguous.
+    """
+    view = memoryview(value)
+    if not getattr(view, 'c_contiguous', True):
+        raise ValueError('Can only encode C-contiguous buffers as blobs.')
+    if view.ndim != 1 or view.itemsize != 1 or view.format != 'B':
+        try:
+            view = view.cast('B')
+        except AttributeError:  # pragma: no cover - Legacy Python
+            view = memoryview(view.tobytes())
+    return view
+
+
+def _seekable(f):
+    """ Get whether the given file object can seek.
+    """
+    seekable = getattr(f, 'seekable', None)
+    if seekable is not None:
+        return bool(seekable())
+    try:  # e.g. file objects on Legacy Python have no seekable()
+        f.seek(0, 1)
+        return True
+    except Exception:
+        return False
+
+
+def _skip_bytes(f, n, seekable=None):
+    """ Skip n bytes in the given file. Large amounts are seeked over if
+    the file is seekable (which is determined if not given); otherwise the
+    bytes are read, raising EOFError if the file ends prematurely.
+    """
+    if seekable is None:
+        seekable = _seekable(f)
+    if seekable and n > _SKIP_SEEK_SIZE:
+        f.seek(n, 1)
+    else:
+        while n > 0:
+            bb = f.read(min(n, 2 ** 20))
+            if not bb:
+                raise EOFError()
+            n -= len(bb)
+
+
+# Byte sizes of the values of fixed-width types, by type char
+_SCALAR_SIZES = {b'v': 0, b'y': 0, b'n': 0,
+                 b'h': 2, b'f': 4, b'i': 8, b'd': 8}
+
+# Skipping over fewer bytes is done by reading rather than seeking
+_SKIP_SEEK_SIZE = 2 ** 12
 
 
 # %% Streaming and blob-files
@@ -477,8 +1734,16 @@ class BaseStream(object):
         assert mode in ('r', 'w')
         self._mode = mode
         self._f = None
+        self._owns_file = False
         self._start_pos = 0
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if self._owns_file:
+            self._f.close()
+
     def _activate(self, file, encode_func, decode_func):
         if self._f is not None:  # Associated with another write
             raise IOError('Stream object cannot be activated twice?')
@@ -487,6 +1752,10 @@ class BaseStream(object):
         self._encode = encode_func
         self._decode = decode_func
 
+    @property
+    def _serializer(self):
+        return self._decode.__self__
+
     @property
     def mode(self):
         """ The mode of this stream: 'r' or 'w'.
@@ -497,8 +1766,74 @@ class BaseStream(object):
 class ListStream(BaseStream):
     """ A streamable list object used for writing or reading.
     In read mode, it can also be iterated over.
+
+    In write mode, items are written without durability guarantees by
+    default. With ``sync_items`` and/or ``sync_interval`` (in seconds), a
+    checkpoint is made after that many items or that much time: the data is
+    flushed to disk (fsync) and the item count is written in the stream's
+    header (marking it as closed). With ``sync_interval``, a timer thread
+    makes the checkpoint if no more items are appended. After a crash, at
+    most the items since the last checkpoint are lost, and `recover_stream()`
+    can be used to recover them (if complete). With ``group_commit``,
+    ``append()`` only returns when the item is on disk, and threads that
+    append concurrently share the fsync calls. Call ``close()`` when done,
+    to make all items visible to readers.
+
+    With ``queue_size``, items are encoded in the calling thread, and written
+    to the file by a background thread, so that ``append()`` does not block
+    on I/O (unless ``queue_size`` encoded items are waiting to be written).
+    Use ``flush()`` to wait for queued items to be written.
+
+    Appending to a stream (and closing it) is thread-safe. A stream in read
+    mode can be pickled as a reference into its file (see `Blob`).
     """
 
+    def __init__(self, mode='w', sync_items=0, sync_interval=0,
+                 group_commit=False, queue_size=0):
+        BaseStream.__init__(self, mode)
+        self._sync_items = int(sync_items)
+        self._sync_interval = float(sync_interval)
+        self._group_commit = bool(group_commit)
+        self._synced_count = 0
+        self._sync_time = time.time()
+        self._syncing = False
+        self._sync_timer = None
+        self._lock = threading.Condition(threading.Lock())
+        # Background writer
+        self._queue_size = int(queue_size)
+        self._queue = None
+        self._writer = None
+        self._writer_error = None
+
+    def __exit__(self, type, value, tb):
+        if self._writer is not None:
+            with self._lock:
+                self._drain(stop=True)
+        BaseStream.__exit__(self, type, value, tb)
+
+    def __getstate__(self):
+        # A stream in read mode pickles as a reference into its file, at
+        # the current position, and its serializer (via the decode method).
+        if self._mode != 'r':
+            raise TypeError('Can only pickle a ListStream in read mode.')
+        state = dict(self.__dict__)
+        for key in ('_lock', '_queue', '_writer', '_sync_timer',
+                    '_owns_file'):
+            state.pop(key, None)
+        if self._f is not None:
+            state['_f'] = _file_reference(self._f), self._f.tell()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Condition(threading.Lock())
+        self._queue = self._writer = self._sync_timer = None
+        self._owns_file = False
+        if self._f is not None:
+            ref, pos = self._f
+            self._f = _reopen_file(ref)
+            self._f.seek(pos)
+
     @property
     def count(self):
         """ The number of elements in the stream (can be -1 for unclosed
@@ -514,19 +1849,175 @@ class ListStream(BaseStream):
 
     def append(self, item):
         """ Append an item to the streaming list. The object is immediately
-        serialized and written to the underlying file.
+        serialized and written to the underlying file (or queued to be
+        written, if ``queue_size`` is set).
         """
         # if self._mode != 'w':
         #     raise IOError('This ListStream is not in write mode.')
-        if self._count != self._i:
-            raise IOError('Can only append items to the end of the stream.')
-        if self._f is None:
-            raise IOError('List stream is not associated with a file yet.')
-        if self._f.closed:
-            raise IOError('Cannot stream to a close file.')
-        self._encode(self._f, item, [self], None)
-        self._i += 1
-        self._count += 1
+        with self._lock:
+            if self._count != self._i:
+                raise IOError('Can only append items to the end '
+                              'of the stream.')
+            if self._f is None:
+                raise IOError('List stream is not associated with a '
+                              'file yet.')
+            if self._f.closed:
+                raise IOError('Cannot stream to a close file.')
+            if self._queue_size:
+                self._put(item)
+            else:
+                self._encode(self._f, item, [self], None)
+            self._i += 1
+            self._count += 1
+            # Durability
+            if self._group_commit:
+                self._sync(self._count)
+            elif ((self._sync_items and self._count - self._synced_count >=
+                   self._sync_items) or
+                  (self._sync_interval and time.time() - self._sync_time >=
+                   self._sync_interval)):
+                self._sync(self._count)
+            elif self._sync_interval and self._sync_timer is None:
+                self._start_sync_timer()
+
+    def _start_sync_timer(self):
+        """ Start a timer to make a checkpoint when the sync interval has
+        passed since the last one. Must be called with the lock held.
+        """
+        delay = self._sync_time + self._sync_interval - time.time()
+        self._sync_timer = threading.Timer(delay, self._sync_on_timer)
+        self._sync_timer.daemon = True
+        self._sync_timer.start()
+
+    def _sync_on_timer(self):
+        """ Make a checkpoint for the items appended since the last one.
+        Runs in the timer thread.
+        """
+        with self._lock:
+            self._sync_timer = None
+            if self._f.closed or self._synced_count >= self._count:
+                return
+            elif time.time() - self._sync_time < self._sync_interval:
+                self._start_sync_timer()  # a checkpoint was made meanwhile
+                return
+            try:
+                self._sync(self._count)
+            except Exception as err:
+                logger.warning('BSDF warning: could not sync stream: %s' %
+                               str(err))
+
+    def _put(self, item):
+        """ Encode an item and queue it for the background writer.
+        """
+        if self._writer is None:
+            self._queue = queue.Queue(self._queue_size)
+            self._pos = self._f.tell()
+            self._writer = threading.Thread(target=self._write_queued,
+                                            name='ListStream writer')
+            self._writer.daemon = True
+            self._writer.start()
+        self._check_writer()
+        f = _OffsetFile(self._pos)  # encoding can depend on the position
+        self._encode(f, item, [self], None)
+        bb = f.getvalue()
+        self._pos += len(bb)
+        self._queue.put(bb)
+
+    def _write_queued(self):
+        """ Write queued items to the file, until None is received. Runs in
+        the background writer thread.
+        """
+        q = self._queue
+        while True:
+            bb = q.get()
+            try:
+                if bb is None:
+                    return
+                elif self._writer_error is None:
+                    self._f.write(bb)
+            except Exception as err:
+                self._writer_error = err
+            finally:
+                q.task_done()
+
+    def _check_writer(self):
+        if self._writer_error is not None:
+            raise IOError('Writing a queued stream item failed: %s' %
+                          str(self._writer_error))
+
+    def _drain(self, stop=False):
+        """ Wait until the queued items are written. Must be called with
+        the lock held.
+        """
+        if self._writer is not None:
+            self._queue.join()
+            if stop:
+                self._queue.put(None)
+                self._writer.join()
+                self._writer = None
+            self._check_writer()
+
+    def flush(self):
+        """ Wait until all queued items are written, and flush the file.
+        """
+        with self._lock:
+            if self._f is None:
+                raise IOError('ListStream is not associated with a file yet.')
+            self._drain()
+            self._f.flush()
+
+    def sync(self):
+        """ Make a checkpoint: flush all items to disk and write the item
+        count in the stream's header (marking it as closed).
+        """
+        with self._lock:
+            if self._f is None:
+                raise IOError('ListStream is not associated with a file yet.')
+            self._sync(self._count)
+
+    def _sync(self, count):
+        """ Make sure that the first count items are durable. If another
+        thread is syncing, wait for it, so that its sync may cover ours.
+        Must be called with the lock held.
+        """
+        while self._synced_count < count:
+            if self._syncing:
+                self._lock.wait()
+                continue
+            self._syncing = True
+            try:
+                # Flush the data, then the count, so the count is never
+                # larger than the number of items on disk.
+                self._drain()
+                count = self._count
+                self._f.flush()
+                self._lock.release()
+                try:
+                    _fsync(self._f)
+                finally:
+                    self._lock.acquire()
+                self._drain()  # the writer must not write during seeking
+                self._write_count(254, count)
+                self._f.flush()
+                self._lock.release()
+                try:
+                    _fsync(self._f)
+                finally:
+                    self._lock.acquire()
+                self._synced_count = count
+                self._sync_time = time.time()
+            finally:
+                self._syncing = False
+                self._lock.notify_all()
+
+    def _write_count(self, flag, count):
+        """ Write the stream's header with the given flag and count.
+        """
+        i = self._f.tell()
+        self._f.seek(self._start_pos - 8 - 1)
+        self._f.write(spack('<B', flag))
+        self._f.write(spack('<Q', count))
+        self._f.seek(i)
 
     def close(self, unstream=False):
         """ Close the stream, marking the number of written elements. New
@@ -536,17 +2027,26 @@ class ListStream(BaseStream):
         """
         # if self._mode != 'w':
         #     raise IOError('This ListStream is not in write mode.')
-        if self._count != self._i:
-            raise IOError('Can only close when at the end of the stream.')
-        if self._f is None:
-            raise IOError('ListStream is not associated with a file yet.')
-        if self._f.closed:
-            raise IOError('Cannot close a stream on a close file.')
-        i = self._f.tell()
-        self._f.seek(self._start_pos - 8 - 1)
-        self._f.write(spack('<B', 253 if unstream else 254))
-        self._f.write(spack('<Q', self._count))
-        self._f.seek(i)
+        with self._lock:
+            if self._count != self._i:
+                raise IOError('Can only close when at the end of the stream.')
+            if self._f is None:
+                raise IOError('ListStream is not associated with a '
+                              'file yet.')
+            if self._f.closed:
+                raise IOError('Cannot close a stream on a close file.')
+            self._drain(stop=True)
+            if self._sync_timer is not None:
+                self._sync_timer.cancel()
+                self._sync_timer = None
+            durable = (self._sync_items or self._sync_interval or
+                       self._group_commit)
+            if durable:
+                self._sync(self._count)
+            self._write_count(253 if unstream else 254, self._count)
+            if durable and unstream:
+                self._f.flush()
+                _fsync(self._f)
 
     def next(self):
         """ Read and return the next element in the streaming list.
@@ -581,35 +2081,326 @@ class ListStream(BaseStream):
     def __next__(self):
         return self.next()
 
+    def map(self, func=None, workers=None, ordered=True, chunk_size=2**22):
+        """ Decode the remaining items of the stream in parallel using a pool
+        of worker processes, optionally transforming each item with ``func``
+        (in the worker process). Returns a generator that produces the
+        (transformed) items, in order if ``ordered`` is True, and otherwise in
+        the order in which they become available. The stream is split into
+        ranges of about ``chunk_size`` bytes by scanning the items (without
+        decoding them). ``workers`` defaults to the number of CPUs.
+
+        This requires a stream in read-mode on a file that can be reopened
+        by name. The func, extensions and decoded items must be picklable.
+        """
+        if self._mode != 'r':
+            raise IOError('This ListStream in not in read mode.')
+        if self._f is None:
+            raise IOError('ListStream is not associated with a file yet.')
+        if getattr(self._f, 'closed', None):
+            raise IOError('Cannot read a stream from a close file.')
+        filename = getattr(self._f, 'name', None)
+        if not isinstance(filename, string_types):
+            raise IOError('Can only map a ListStream of a named file.')
+
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        try:
+            tasks = ((filename, self._serializer, pos, n, func)
+                     for pos, n in self._scan_ranges(chunk_size))
+            imap = pool.imap if ordered else pool.imap_unordered
+            for items in imap(_decode_stream_range, tasks):
+                for item in items:
+                    yield item
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _scan_ranges(self, chunk_size):
+        """ Generate (position, number of items) tuples for the remaining
+        items, by skipping over them, so that each range spans about
+        chunk_size bytes. When done, the stream is at its end.
+        """
+        f = self._f
+        skip = self._serializer._skip
+        seekable = _seekable(f)
+        range_start = f.tell()
+        range_n = 0
+        while self._count < 0 or self._i < self._count:
+            try:
+                skip(f, seekable)
+            except EOFError:
+                self._count = self._i
+                break
+            self._i += 1
+            range_n += 1
+            if f.tell() - range_start >= chunk_size:
+                yield range_start, range_n
+                range_start, range_n = f.tell(), 0
+        if range_n:
+            yield range_start, range_n
+
 
-class Blob(object):
-    """ Object to represent a blob of bytes. When used to write a BSDF file,
-    it's a wrapper for bytes plus properties such as what compression to apply.
-    When used to read a BSDF file, it can be used to read the data lazily, and
-    also modify the data if reading in 'r+' mode and the blob isn't compressed.
+def _decode_stream_range(args):
+    """ Decode (and transform) n stream items at the given position in the
+    given file. Used by worker processes in ListStream.map().
+    """
+    filename, serializer, pos, n, func = args
+    with open(filename, 'rb') as f:
+        f.seek(pos)
+        items = [serializer._decode(f) for i in range(n)]
+    if func is not None:
+        items = [func(item) for item in items]
+    return items
+
+
+class StreamAppender(object):
+    """ Object to append items to the stream at the end of a BSDF file,
+    which can be used by multiple processes at once. Items are encoded
+    in the calling process and buffered; buffered items are written in one
+    go under an exclusive advisory lock on the file (``fcntl.flock``), and
+    the count in the stream's header is updated accordingly. Items from one
+    batch are thus never interleaved with those of other processes, and
+    bytes beyond the counted items (e.g. of a process that crashed while
+    writing) are truncated before writing.
+
+    Parameters:
+
+    * filename (str): the file, which must have a stream at the end (see
+      `open_stream_for_append()`). On opening, the stream is recovered
+      (under the lock) and marked as closed with its current count.
+    * batch_size (int): the number of items to buffer before writing them.
+      Default 100. Call ``flush()`` to write earlier.
+    * extensions, options: see `BsdfSerializer`.
+
+    Use as a context manager, or call ``close()`` to write the remaining
+    items. Only available on Unix.
     """
 
-    # For now, this does not allow re-sizing blobs (within the allocated size)
-    # but this can be added later.
+    def __init__(self, filename, batch_size=100, extensions=None, **options):
+        import fcntl  # fail early if not available
+        self._flock = fcntl.flock
+        self._lock_ex, self._lock_un = fcntl.LOCK_EX, fcntl.LOCK_UN
+        self._s = BsdfSerializer(extensions, **options)
+        self._batch_size = max(1, int(batch_size))
+        self._buffer = _SegmentFile()  # realigned when written
+        self._n = 0
+        if filename.startswith(('~/', '~\\')):  # pragma: no cover
+            filename = os.path.expanduser(filename)
+        # Unbuffered, so reads are never stale after another process wrote
+        self._f = FileIO(filename, 'r+b')
+        try:
+            self._lock()
+            try:
+                f = BufferedRandom(self._f)  # buffered to recover fast
+                try:
+                    stream = self._s.open_stream_for_append(f)
+                    self._end = f.tell()  # the end of the committed items
+                    stream.close()
+                    f.flush()
+                finally:
+                    f.detach()
+                self._header_pos = stream._start_pos - 9
+                self._count = stream._count
+            finally:
+                self._lock(False)
+        except Exception:
+            self._f.close()
+            raise
+
+    def __enter__(self):
+        return self
 
-    def __init__(self, bb, compression=0, extra_size=0, use_checksum=False):
-        if isinstance(bb, bytes):
-            self._f = None
-            self.compressed = self._from_bytes(bb, compression)
-            self.compression = compression
-            self.allocated_size = self.used_size + extra_size
-            self.use_checksum = use_checksum
-        elif isinstance(bb, tuple) and len(bb) == 2 and hasattr(bb[0], 'read'):
-            self._f, allow_seek = bb
-            self.compressed = None
-            self._from_file(self._f, allow_seek)
-            self._modified = False
-        else:
-            raise TypeError('Wrong argument to create Blob.')
+    def __exit__(self, type, value, traceback):
+        self.close()
 
-    def _from_bytes(self, value, compression):
-        """ When used to wrap bytes in a blob.
+    def _lock(self, lock=True):
+        self._flock(self._f.fileno(), self._lock_ex if lock else self._lock_un)
+
+    @property
+    def closed(self):
+        """ Whether this appender is closed.
+        """
+        return self._f.closed
+
+    def append(self, item):
+        """ Encode the given item, and add it to the buffer. The buffered
+        items are written when the batch is full.
+        """
+        if self._f.closed:
+            raise IOError('Cannot append to a closed StreamAppender.')
+        pos = self._buffer.tell()
+        alignment_pos = self._buffer.alignment_pos
+        streams = []
+        try:
+            self._s._encode(self._buffer, item, streams, None)
+            if streams:
+                raise ValueError('Cannot append streams with a '
+                                 'StreamAppender.')
+        except Exception:
+            self._buffer.seek(pos)
+            self._buffer.truncate()
+            self._buffer.alignment_pos = alignment_pos
+            raise
+        self._n += 1
+        if self._n >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Write all buffered items to the stream, under the file lock.
+        """
+        if self._n == 0:
+            return
+        bb, n = self._buffer.getvalue(), self._n
+        f = self._f
+        self._lock()
+        try:
+            # Find the end of the items committed since our last write, and
+            # truncate what's beyond (e.g. torn items of a crashed process)
+            f.seek(self._header_pos + 1)
+            count = strunpack('<Q', f.read(8))[0]
+            if count != self._count:
+                self._end = self._skip_items(self._end, count - self._count)
+                self._count = count
+            end = self._end
+            if f.seek(0, 2) > end:
+                f.truncate(end)
+            f.seek(end)
+            try:
+                bb = _realign(bb, self._buffer.alignment_pos, end)
+                _write_all(f, bb)
+                f.seek(self._header_pos)
+                _write_all(f, spack('<BQ', 254, count + n))
+            except Exception:
+                # Leave the stream in a consistent state
+                f.truncate(end)
+                raise
+            self._end, self._count = end + len(bb), count + n
+        finally:
+            self._lock(False)
+        self._buffer = _SegmentFile()
+        self._n = 0
+
+    def _skip_items(self, pos, n):
+        """ Get the end position of the n items at the given position.
+        """
+        f = BufferedReader(self._f)
+        try:
+            f.seek(pos)
+            for i in range(n):
+                self._s._skip(f, True)
+            return f.tell()
+        finally:
+            f.detach()
+
+    def close(self):
+        """ Write remaining items and close the file.
+        """
+        if not self._f.closed:
+            try:
+                self.flush()
+            finally:
+                self._f.close()
+
+
+class Blob(object):
+    """ Object to represent a blob of bytes. When used to write a BSDF file,
+    it's a wrapper for bytes plus properties such as what compression to apply.
+    Other C-contiguous buffers (e.g. bytearray, memoryview, mmap) can be
+    wrapped too, without copying their data.
+    When used to read a BSDF file, it can be used to read the data lazily, and
+    also modify the data if reading in 'r+' mode and the blob isn't compressed.
+    Uncompressed blobs can also be resized within their allocated size.
+    Blobs read from a file can be pickled (e.g. to send them to worker
+    processes) as a reference into the file, which is reopened on demand.
+    To embed the contents of a (large) file, use `Blob.from_file()`.
+    """
+
+    _cache = None  # BlobCache for the contents, set by the decoder
+    _source = None  # file to stream the contents from, see from_file()
+
+    def __init__(self, bb, compression=0, extra_size=0, use_checksum=False):
+        if isinstance(bb, tuple) and len(bb) == 2 and hasattr(bb[0], 'read'):
+            self._f, allow_seek = bb
+            self.compressed = None
+            self._from_file(self._f, allow_seek)
+            self._modified = False
+        else:
+            if not isinstance(bb, bytes):
+                try:
+                    bb = _byte_view(bb)  # refer to the data, don't copy it
+                except TypeError:
+                    raise TypeError('Wrong argument to create Blob.')
+            self._f = None
+            self.compressed = self._from_bytes(bb, compression)
+            self.compression = compression
+            self.allocated_size = self.used_size + extra_size
+            self.use_checksum = use_checksum
+
+    @classmethod
+    def from_file(cls, source, compression=0, chunk_size=2**20,
+                  extra_size=0, use_checksum=False):
+        """ Create a blob with the contents of the given file object or
+        filename. When the blob is encoded, the contents are read in chunks
+        of ``chunk_size`` bytes, and are compressed and hashed on the fly,
+        so that memory use is bounded, whatever the size of the file.
+
+        The sizes (and checksum) are written afterwards if the output file
+        is seekable. Otherwise, the source is read twice, to determine them
+        first (unless the data is not compressed and has no checksum). A
+        file object that cannot seek can thus be encoded only once, and
+        only to a seekable output (or without compression and checksum,
+        if its size can be determined). The file is read from its current
+        position, and is not closed.
         """
+        if compression not in (0, 1, 2):
+            raise TypeError('Compression must be 0, 1, or 2.')
+        self = cls.__new__(cls)
+        self._f = None
+        self.compressed = None
+        self.compression = compression
+        self.use_checksum = bool(use_checksum)
+        self._source = source
+        self._source_start = None  # not seekable
+        self._source_read = False
+        self._chunk_size = int(chunk_size)
+        self._extra_size = int(extra_size)
+        # Get the size of the data, if we can
+        if isinstance(source, string_types):
+            self.data_size = os.path.getsize(source)
+        elif _seekable(source):
+            self._source_start = source.tell()
+            self.data_size = source.seek(0, 2) - self._source_start
+            source.seek(self._source_start)
+        else:
+            self.data_size = None
+        if compression == 0 and self.data_size is not None:
+            self.used_size = self.data_size
+            self.allocated_size = self.used_size + self._extra_size
+        else:
+            self.used_size = self.allocated_size = None  # known when written
+        return self
+
+    def __getstate__(self):
+        # A blob from a file pickles as a reference into that file, which
+        # is reopened (via a shared FilePool) when unpickled.
+        state = dict(self.__dict__)
+        state.pop('_cache', None)
+        if self._f is not None:
+            state['_f'] = _file_reference(self._f)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._f is not None:
+            self._f = _reopen_file(self._f)
+
+    def _from_bytes(self, value, compression):
+        """ When used to wrap bytes in a blob.
+        """
+        if compression and not PY3 and isinstance(value, memoryview):
+            value = value.tobytes()  # pragma: no cover - Legacy Python
         if compression == 0:
             compressed = value
         elif compression == 1:
@@ -626,8 +2417,24 @@ class Blob(object):
     def _to_file(self, f):
         """ Private friend method called by encoder to write a blob to a file.
         """
+        if self._source is not None:
+            return self._source_to_file(f)
+        if self.use_checksum:
+            checksum = hashlib.md5(self.compressed).digest()
+        else:
+            checksum = None
+        self._write_header(f, checksum)
+        # The actual data and extra space
+        f.write(self.compressed)
+        _write_padding(f, self.allocated_size - self.used_size)
+
+    def _write_header(self, f, checksum, large=False):
+        """ Write the blob header. Sizes are written in their large form if
+        ``large`` is True, so that they can be backpatched.
+        """
         # Write sizes - write at least in a size that allows resizing
-        if self.allocated_size <= 250 and self.compression == 0:
+        if (self.allocated_size <= 250 and self.compression == 0 and
+                not large):
             f.write(spack('<B', self.allocated_size))
             f.write(spack('<B', self.used_size))
             f.write(lencode(self.data_size))
@@ -637,20 +2444,109 @@ class Blob(object):
             f.write(spack('<BQ', 253, self.data_size))
         # Compression and checksum
         f.write(spack('B', self.compression))
-        if self.use_checksum:
-            f.write(b'\xff' + hashlib.md5(self.compressed).digest())
+        if checksum is not None:
+            f.write(b'\xff' + checksum)
         else:
             f.write(b'\x00')
         # Byte alignment (only necessary for uncompressed data)
         if self.compression == 0:
-            alignment = 8 - (f.tell() + 1) % 8  # +1 for the byte to write
+            pos = f.tell()
+            if isinstance(f, _SegmentFile) and f.alignment_pos is None:
+                f.alignment_pos = pos  # for realigning
+            alignment = 8 - (pos + 1) % 8  # +1 for the byte to write
             f.write(spack('<B', alignment))  # padding for byte alignment
             f.write(b'\x00' * alignment)
         else:
             f.write(spack('<B', 0))
-        # The actual data and extra space
-        f.write(self.compressed)
-        f.write(b'\x00' * (self.allocated_size - self.used_size))
+
+    def _source_to_file(self, f):
+        """ Write a blob created with from_file(), streaming the data.
+        """
+        if self.used_size is None or self.use_checksum:
+            if _seekable(f):
+                # Write the header with placeholders, and backpatch it
+                large = self.used_size is None
+                if large:
+                    self.used_size = self.allocated_size = 0
+                    self.data_size = self.data_size or 0
+                checksum = b'\x00' * 16 if self.use_checksum else None
+                i0 = f.tell()
+                self._write_header(f, checksum, large)
+                checksum = self._stream_source(f)
+                _write_padding(f, self.allocated_size - self.used_size)
+                i1 = f.tell()
+                f.seek(i0)
+                self._write_header(f, checksum, large)
+                f.seek(i1)
+                return
+            # Determine the sizes and checksum in a first pass
+            if self._source_start is None and not isinstance(
+                    self._source, string_types):
+                raise IOError('Cannot write a blob from a file that cannot '
+                              'seek to a file that cannot seek, unless it is '
+                              'uncompressed, has no checksum, and the size '
+                              'is known.')
+            checksum = self._stream_source(None)
+        else:
+            checksum = None
+        sizes = self.used_size, self.data_size
+        self._write_header(f, checksum)
+        if self._stream_source(f) != checksum or sizes != (self.used_size,
+                                                           self.data_size):
+            raise IOError('The source file of the blob has changed '
+                          'while writing it.')
+        _write_padding(f, self.allocated_size - self.used_size)
+
+    def _stream_source(self, f):
+        """ Read the source in chunks, compress, and write to the given file
+        (if not None). Sets the sizes, and returns the checksum (or None).
+        """
+        if self.compression == 1:
+            compressor = zlib.compressobj(9)
+        elif self.compression == 2:
+            compressor = bz2.BZ2Compressor(9)
+        else:
+            compressor = None
+        md5 = hashlib.md5() if self.use_checksum else None
+        self.data_size = self.used_size = 0
+
+        def put(chunk):
+            if md5 is not None:
+                md5.update(chunk)
+            if f is not None:
+                f.write(chunk)
+            self.used_size += len(chunk)
+
+        for chunk in self._iter_source():
+            self.data_size += len(chunk)
+            put(chunk if compressor is None else compressor.compress(chunk))
+        if compressor is not None:
+            put(compressor.flush())
+        self.allocated_size = self.used_size + self._extra_size
+        return None if md5 is None else md5.digest()
+
+    def _iter_source(self):
+        """ Yield the contents of the source file in chunks.
+        """
+        if isinstance(self._source, string_types):
+            fsrc = open(self._source, 'rb')
+        else:
+            fsrc = self._source
+            if self._source_start is not None:
+                fsrc.seek(self._source_start)
+            elif self._source_read:
+                raise IOError('Cannot read from a file that cannot seek '
+                              'more than once.')
+            self._source_read = True
+        try:
+            while True:
+                chunk = fsrc.read(self._chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            if fsrc is not self._source:
+                fsrc.close()
 
     def _from_file(self, f, allow_seek):
         """ Used when a blob is read by the decoder.
@@ -659,6 +2555,8 @@ class Blob(object):
         # Size
         allocated_size = strunpack('<B', f.read(1))[0]
         if allocated_size == 253: allocated_size = strunpack('<Q', f.read(8))[0]  # noqa
+        if allow_seek:
+            self._used_size_pos = f.tell()  # for resizing
         used_size = strunpack('<B', f.read(1))[0]
         if used_size == 253: used_size = strunpack('<Q', f.read(8))[0]  # noqa
         data_size = strunpack('<B', f.read(1))[0]
@@ -679,8 +2577,13 @@ class Blob(object):
         else:
             self.start_pos = None
             self.end_pos = None
-            self.compressed = f.read(used_size)
-            f.read(allocated_size - used_size)
+            if isinstance(f, _MemoryFile):
+                self.compressed = f.read_view(used_size)  # no copy
+            else:
+                self.compressed = f.read(used_size)
+            if len(self.compressed) < used_size:
+                raise EOFError('Blob data is truncated.')
+            _skip_bytes(f, allocated_size - used_size)
         # Store info
         self.alignment = alignment
         self.compression = compression
@@ -720,6 +2623,8 @@ class Blob(object):
         if self._f.tell() + len(bb) > self.end_pos:
             raise IOError('Write beyond blob boundaries.')
         self._modified = True
+        if self._cache is not None:
+            self._cache.invalidate(self._f, self.start_pos)
         return self._f.write(bb)
 
     def read(self, n):
@@ -735,8 +2640,20 @@ class Blob(object):
         return self._f.read(n)
 
     def get_bytes(self):
-        """ Get the contents of the blob as bytes.
+        """ Get the contents of the blob as bytes. If the blob has a cache
+        (see `BlobCache`), the contents are only read once.
         """
+        if self.compressed is None and self._cache is not None:
+            value = self._cache.get(self._f, self.start_pos)
+            if value is None:
+                value = self._get_bytes()
+                self._cache.put(self._f, self.start_pos, value)
+            return value
+        return self._get_bytes()
+
+    def _get_bytes(self):
+        if self._source is not None:
+            return b''.join(self._iter_source())
         if self.compressed is not None:
             compressed = self.compressed
         else:
@@ -754,6 +2671,38 @@ class Blob(object):
             raise RuntimeError('Invalid compression %i' % self.compression)
         return value
 
+    def resize(self, n):
+        """ Resize the (uncompressed) blob to n bytes, within its allocated
+        size. The new size is written to the file, which must be writable.
+        Note that bytes exposed by growing the blob are not initialized.
+        """
+        if self._f is None:
+            raise RuntimeError('Cannot resize a blob '
+                               'that is not created by the BSDF decoder.')
+        if self.compression:
+            raise IOError('Cannot resize a compressed blob.')
+        if not 0 <= n <= self.allocated_size:
+            raise IOError('Cannot resize a blob beyond its allocated size.')
+        i = self._f.tell()
+        # Overwrite used_size and data_size (which are equal), keeping the
+        # width of their encoding.
+        self._f.seek(self._used_size_pos)
+        used_size_wide = self._f.read(1) == b'\xfd'
+        self._f.seek(self._used_size_pos + (9 if used_size_wide else 1))
+        data_size_wide = self._f.read(1) == b'\xfd'
+        if n > 250 and not (used_size_wide and data_size_wide):
+            self._f.seek(i)
+            raise IOError('Cannot grow this blob beyond 250 bytes.')
+        self._f.seek(self._used_size_pos)
+        for wide in (used_size_wide, data_size_wide):
+            self._f.write(spack('<BQ', 253, n) if wide else spack('<B', n))
+        self._f.seek(i)
+        self.used_size = self.data_size = n
+        self.end_pos = self.start_pos + n
+        self._modified = True
+        if self._cache is not None:
+            self._cache.invalidate(self._f, self.start_pos)
+
     def update_checksum(self):
         """ Reset the blob's checksum if present. Call this after modifying
         the data.
@@ -766,15 +2715,909 @@ class Blob(object):
             self._f.write(hashlib.md5(compressed).digest())
 
 
+class BlobCache(object):
+    """ A cache for the contents of lazily loaded blobs, to avoid reading
+    (and decompressing) the same data repeatedly. Use it via the
+    ``blob_cache`` option, e.g. ``load(f, lazy_blob=True, blob_cache=c)``.
+    A cache can be shared by multiple files and threads.
+
+    Contents are keyed by the file (its path, if it has one) and the
+    position of the blob. For local files, the key includes the file's
+    identity (device, inode, modification time and size), so that the
+    contents of a file that is replaced or rewritten are not confused with
+    the old contents. The least recently used contents are evicted
+    when the total size exceeds ``max_bytes``. Writing to a blob (via
+    `Blob.write()`, `Blob.resize()` or `patch()` with the same cache)
+    invalidates its entry; changes made otherwise are not detected.
+    The ``hits`` and ``misses`` attributes hold statistics.
+    """
+
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._items = OrderedDict()  # key -> bytes
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        # Pickle as an empty cache, e.g. to send a serializer to workers
+        return self.__class__, (self.max_bytes, )
+
+    def __repr__(self):
+        return '<BlobCache with %i items (%i bytes), %i hits, %i misses>' % (
+            len(self._items), self._size, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def size(self):
+        """ The total size of the cached contents, in bytes.
+        """
+        return self._size
+
+    def _key(self, f, pos):
+        name = getattr(f, 'name', None)
+        if isinstance(name, string_types):
+            if '://' in name:  # a url
+                return name, pos
+            try:
+                st = os.fstat(f.fileno())
+            except (AttributeError, IOError, OSError, ValueError):
+                try:
+                    st = os.stat(name)
+                except (IOError, OSError):
+                    return os.path.abspath(name), None, pos
+            identity = (st.st_dev, st.st_ino,
+                        getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size)
+            return os.path.abspath(name), identity, pos
+        return f, pos  # keeps f alive while cached, so its id is not reused
+
+    def get(self, f, pos):
+        """ Get the contents of the blob at the given position in the given
+        file, or None if not cached.
+        """
+        key = self._key(f, pos)
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is None:
+                self.misses += 1
+            else:
+                self._items[key] = value  # mark as recently used
+                self.hits += 1
+            return value
+
+    def put(self, f, pos, value):
+        """ Store the contents of the blob at the given position in the
+        given file.
+        """
+        if len(value) > self.max_bytes:
+            return
+        key = self._key(f, pos)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                self._size -= len(self._items.popitem(last=False)[1])
+
+    def invalidate(self, f, pos):
+        """ Remove the contents of the blob at the given position in the
+        given file from the cache.
+        """
+        key = self._key(f, pos)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+
+    def clear(self):
+        """ Remove all contents from the cache.
+        """
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+
+class LoadCache(object):
+    """ A cache for whole-file loads, for use with ``load(filename,
+    cache=c)``, so that loading the same file again costs a ``stat()``
+    instead of a full decode. Entries are keyed by the path, extensions and
+    options, and are used only while the file's modification time and size
+    are unchanged.
+
+    The least recently used entries are evicted when the total size of the
+    cached files exceeds ``max_bytes`` (the size of the decoded objects is
+    estimated by the file size). If ``copy`` is False (default), loads of
+    the same file return the same object, which should then not be
+    modified; otherwise each load returns a deep copy. A cache can be
+    shared by multiple threads. The ``hits`` and ``misses`` attributes hold
+    statistics.
+    """
+
+    def __init__(self, max_bytes=2**28, copy=False):
+        self.max_bytes = int(max_bytes)
+        self.copy = bool(copy)
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._items = OrderedDict()  # key -> (stat key, size, object)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<LoadCache with %i items (%i bytes), %i hits, %i misses>' % (
+            len(self._items), self._size, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def size(self):
+        """ The total size of the cached files, in bytes.
+        """
+        return self._size
+
+    def _load(self, filename, extensions, options):
+        if options.get('lazy_blob') or options.get('load_streaming'):
+            raise ValueError('Cannot use a load cache with lazy_blob or '
+                             'load_streaming.')
+        if filename.startswith(('~/', '~\\')):  # pragma: no cover
+            filename = os.path.expanduser(filename)
+        filename = os.path.abspath(filename)
+        ext_key = None if extensions is None else tuple(extensions)
+        key = filename, ext_key, tuple(sorted(options.items()))
+        # Stat before reading, so that changes during reading are detected
+        st = os.stat(filename)
+        stat_key = getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None and item[0] == stat_key:
+                self._items[key] = item  # mark as recently used
+                self.hits += 1
+                ob = item[2]
+            else:
+                if item is not None:
+                    self._size -= item[1]
+                self.misses += 1
+                ob = None
+        if ob is None:
+            s = BsdfSerializer(extensions, **options)
+            with open(filename, 'rb') as fp:
+                ob = s.load(fp)
+            self._put(key, (stat_key, st.st_size, ob))
+        if self.copy:
+            import copy
+            ob = copy.deepcopy(ob)
+        return ob
+
+    def _put(self, key, item):
+        if item[1] > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._items[key] = item
+            self._size += item[1]
+            while self._size > self.max_bytes:
+                self._size -= self._items.popitem(last=False)[1][1]
+
+    def invalidate(self, filename):
+        """ Remove the entries for the given file from the cache.
+        """
+        filename = os.path.abspath(os.path.expanduser(filename))
+        with self._lock:
+            for key in [key for key in self._items if key[0] == filename]:
+                self._size -= self._items.pop(key)[1]
+
+    def clear(self):
+        """ Remove all entries from the cache.
+        """
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+
+class FilePool(object):
+    """ A pool of file handles, to keep lazy references (e.g. lazily loaded
+    blobs and streams) into many files without running out of file
+    descriptors. Use ``pool.open(filename)`` to get a file object to load
+    from, e.g. ``load(pool.open(filename), lazy_blob=True)``.
+
+    Such file objects refer to a path and position; the underlying files
+    are opened on demand, and the least recently used ones are closed when
+    more than ``max_open`` files are open. A pool can be shared by multiple
+    threads. The ``opens`` attribute holds the number of times that a file
+    was opened.
+    """
+
+    def __init__(self, max_open=64):
+        self.max_open = max(1, int(max_open))
+        self.opens = 0
+        self._files = OrderedDict()  # (path, mode) -> file
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._files)
+
+    def open(self, filename, mode='rb'):
+        """ Get a file object for the given filename, which uses a pooled
+        file handle. The mode must be 'rb' or 'r+b'.
+        """
+        if mode not in ('rb', 'r+b'):
+            raise ValueError('FilePool mode must be "rb" or "r+b".')
+        if filename.startswith(('~/', '~\\')):  # pragma: no cover
+            filename = os.path.expanduser(filename)
+        filename = os.path.abspath(filename)
+        self._get((filename, mode))  # fail early if it cannot be opened
+        return _PooledFile(self, filename, mode)
+
+    def _get(self, key):
+        """ Get the file handle for the given key, opening it if necessary.
+        """
+        with self._lock:
+            f = self._files.pop(key, None)
+            if f is None:
+                f = open(key[0], key[1])
+                self.opens += 1
+                while len(self._files) >= self.max_open:
+                    self._files.popitem(last=False)[1].close()
+            self._files[key] = f  # mark as recently used
+            return f
+
+    def close(self):
+        """ Close all open file handles. They are reopened when needed.
+        """
+        with self._lock:
+            while self._files:
+                self._files.popitem()[1].close()
+
+
+# The pool for files that are reopened by unpickled blobs and streams
+_unpickle_pool = None
+
+
+def _file_reference(f):
+    """ Get a (path or url, mode) tuple to reopen the given file, e.g. in
+    another process.
+    """
+    name = getattr(f, 'name', None)
+    if isinstance(f, HttpRangeFile):
+        return name, 'http'
+    elif not isinstance(name, string_types):
+        raise TypeError('Can only pickle blobs and streams from files '
+                        'that have a name (path).')
+    mode = getattr(f, 'mode', 'rb')
+    return os.path.abspath(name), 'r+b' if '+' in mode else 'rb'
+
+
+def _reopen_file(reference):
+    """ Reopen a file from a reference made with _file_reference().
+    """
+    global _unpickle_pool
+    name, mode = reference
+    if mode == 'http':
+        return HttpRangeFile(name)
+    if _unpickle_pool is None:
+        _unpickle_pool = FilePool()
+    return _unpickle_pool.open(name, mode)
+
+
+class _PooledFile(object):
+    """ File object that uses a file handle from a FilePool.
+    """
+
+    def __init__(self, pool, filename, mode):
+        self._pool = pool
+        self._key = filename, mode
+        self.name = filename
+        self.mode = mode
+        self._pos = 0
+        self._closed = False
+
+    def __reduce__(self):
+        return _reopen_file, (self._key, )
+
+    def _file(self):
+        if self._closed:
+            raise ValueError('I/O operation on closed file.')
+        f = self._pool._get(self._key)
+        if f.tell() != self._pos:
+            f.seek(self._pos)
+        return f
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return self.mode == 'r+b'
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=0):
+        with self._pool._lock:
+            f = self._file()
+            self._pos = f.seek(pos, whence) or f.tell()
+            return self._pos
+
+    def read(self, n=-1):
+        with self._pool._lock:
+            f = self._file()
+            bb = f.read(n)
+            self._pos += len(bb)
+            return bb
+
+    def write(self, bb):
+        with self._pool._lock:
+            f = self._file()
+            n = f.write(bb)
+            self._pos = f.tell()
+            return n
+
+    def flush(self):
+        with self._pool._lock:
+            f = self._pool._files.get(self._key, None)
+            if f is not None:
+                f.flush()
+
+
+class SharedMemoryMessage(object):
+    """ A BSDF-encoded message in shared memory, to pass (large) data
+    between local processes without copying it through pipes or sockets.
+    Requires Python 3.8+.
+
+    Use ``SharedMemoryMessage.create(ob)`` to encode an object into a new
+    shared memory segment, and send the message (which pickles as the name
+    and size of the segment) to another process, where ``message.load()``
+    decodes it. Uncompressed blobs are decoded as memoryviews into the
+    shared memory (and ndarrays as views of it), so their data is not
+    copied. Use ``SharedMemoryMessage(name, size)`` to attach to a segment
+    by name.
+
+    Each process should call ``close()`` when it no longer uses the message,
+    and the objects decoded from it (closing raises BufferError while these
+    exist). Messages can be used as context managers, which close them. The
+    creating process owns the segment: it calls ``unlink()`` to destroy it
+    when the receivers are done, and otherwise the segment is destroyed
+    when the creating process ends.
+    """
+
+    def __init__(self, name, size=None):
+        self._attach(name, size, None)
+
+    def _attach(self, name, size, tracker):
+        from multiprocessing import shared_memory
+        try:
+            self._shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:  # pragma: no cover - before Python 3.13
+            self._shm = shared_memory.SharedMemory(name)
+            # Don't let our resource tracker destroy it when we exit
+            if tracker is None or tracker != _resource_tracker_pid():
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self.name = name
+        self.size = self._shm.size if size is None else int(size)
+        self._tracker = tracker
+        self._owner = False
+
+    @classmethod
+    def create(cls, ob, extensions=None, **options):
+        """ Encode the given object into a new shared memory segment, and
+        return it as a SharedMemoryMessage. See `BsdfSerializer` for
+        details on extensions and options. The object cannot contain streams.
+        """
+        from multiprocessing import shared_memory
+        s = BsdfSerializer(extensions, **options)
+        f = _ChunkFile()
+        s._save(f, ob)
+        if f.streams:
+            raise ValueError('Cannot use streams in a SharedMemoryMessage.')
+        shm = shared_memory.SharedMemory(create=True, size=max(1, f.size))
+        pos = 0
+        for chunk in f.chunks:
+            n = len(chunk)
+            shm.buf[pos:pos + n] = chunk
+            pos += n
+        self = cls.__new__(cls)
+        self._shm = shm
+        self.name = shm.name
+        self.size = f.size
+        self._tracker = _resource_tracker_pid()
+        self._owner = True
+        return self
+
+    def __reduce__(self):
+        return _attach_shared_memory, (self.name, self.size, self._tracker)
+
+    def __repr__(self):
+        return '<SharedMemoryMessage %r of %i bytes>' % (self.name, self.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def load(self, extensions=None, **options):
+        """ Decode the message. See `BsdfSerializer` for details on
+        extensions and options.
+        """
+        s = BsdfSerializer(extensions, **options)
+        return s.load(_MemoryFile(self._shm.buf[:self.size]))
+
+    def close(self):
+        """ Detach from the shared memory in this process. Raises BufferError
+        if objects that refer to the shared memory still exist.
+        """
+        self._shm.close()
+
+    def unlink(self):
+        """ Destroy the shared memory segment (once all processes have
+        closed it). Can only be called by the creating process.
+        """
+        if not self._owner:
+            raise RuntimeError('Only the creator of a SharedMemoryMessage '
+                               'can unlink it.')
+        self._shm.unlink()
+
+
+def _attach_shared_memory(name, size, tracker):
+    """ Attach to a SharedMemoryMessage (for unpickling).
+    """
+    self = SharedMemoryMessage.__new__(SharedMemoryMessage)
+    self._attach(name, size, tracker)
+    return self
+
+
+def _resource_tracker_pid():
+    """ Get the pid of the resource tracker used by this process (which
+    can be shared with related processes), or None.
+    """
+    try:
+        from multiprocessing import resource_tracker
+        return resource_tracker._resource_tracker._pid
+    except (ImportError, AttributeError):  # pragma: no cover - Windows
+        return None
+
+
+class _ChunkFile(object):
+    """ File object that collects the written chunks (without joining them),
+    for writing them into shared memory, or with vectored output. The
+    given start position is used to align blobs as in the real file.
+    """
+
+    def __init__(self, start=0):
+        self.chunks = []
+        self.streams = []
+        self.size = 0
+        self._start = start
+
+    def write(self, bb):
+        self.chunks.append(bb)
+        self.size += len(bb)
+
+    def tell(self):
+        return self._start + self.size
+
+
+class _MemoryFile(object):
+    """ Read-only file object over a memoryview. Blob data is read as a
+    view into it (via read_view()); other reads return bytes.
+    """
+
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def read(self, n=-1):
+        return self.read_view(n).tobytes()
+
+    def read_view(self, n):
+        i = self._pos
+        j = len(self._view) if n < 0 else min(i + n, len(self._view))
+        self._pos = j
+        return self._view[i:j]
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += len(self._view)
+        self._pos = min(max(0, pos), len(self._view))
+        return self._pos
+
+
+class HttpRangeFile(object):
+    """ A read-only file object for a remote file, which is read using HTTP
+    range requests. This makes it possible to e.g. load a BSDF file from a
+    web server using ``lazy_blob`` and ``load_streaming``, so that only the
+    data that is actually accessed is downloaded.
+
+    Data is fetched in blocks of ``block_size`` bytes. Consecutive blocks
+    that are missing for a read are fetched in a single request, and the
+    ``cache_blocks`` most recently used blocks are cached. Additional HTTP
+    headers can be given as a dict. The server must support range requests.
+    """
+
+    def __init__(self, url, block_size=2**16, cache_blocks=64, headers=None):
+        try:
+            from urllib.request import Request, urlopen
+        except ImportError:  # pragma: no cover - Legacy Python
+            from urllib2 import Request, urlopen
+        self._request, self._urlopen = Request, urlopen
+        self._url = self.name = url
+        self._block_size = int(block_size)
+        self._cache_blocks = max(1, int(cache_blocks))
+        self._headers = dict(headers or {})
+        self._cache = OrderedDict()  # block index -> bytes
+        self._pos = 0
+        self._closed = False
+        self.requests = 0  # the number of requests made
+        self.size = None
+        self._fetch(0, 1)  # get the first block, and the size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def _fetch(self, first, n):
+        """ Fetch n blocks, starting at the given block index, in a single
+        request. The blocks are cached and returned as a dict.
+        """
+        bs = self._block_size
+        start, stop = first * bs, (first + n) * bs
+        if self.size is not None:
+            stop = min(stop, self.size)
+        headers = dict(self._headers)
+        headers['Range'] = 'bytes=%i-%i' % (start, stop - 1)
+        response = self._urlopen(self._request(self._url, headers=headers))
+        try:
+            if response.getcode() != 206:
+                raise IOError('Server does not support range requests: %s'
+                              % self._url)
+            content_range = response.info().get('Content-Range', '')
+            self.size = int(content_range.rsplit('/', 1)[-1])
+            data = response.read()
+        finally:
+            response.close()
+        self.requests += 1
+        blocks = {}
+        for i in range(n):
+            blocks[first + i] = block = data[i * bs:(i + 1) * bs]
+            self._cache[first + i] = block
+        while len(self._cache) > self._cache_blocks:
+            self._cache.popitem(last=False)
+        return blocks
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        """ Close the file, and clear its cache.
+        """
+        self._closed = True
+        self._cache.clear()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self.size
+        if pos < 0:
+            raise IOError('Cannot seek to a negative position.')
+        self._pos = pos
+        return pos
+
+    def read(self, n=-1):
+        if self._closed:
+            raise ValueError('I/O operation on closed file.')
+        end = self.size
+        if n is not None and n >= 0:
+            end = min(end, self._pos + n)
+        if end <= self._pos:
+            return b''
+        bs = self._block_size
+        first, last = self._pos // bs, (end - 1) // bs
+        # Get blocks from the cache, marking them as recently used
+        blocks, missing = {}, []
+        for i in range(first, last + 1):
+            block = self._cache.pop(i, None)
+            if block is None:
+                missing.append(i)
+            else:
+                blocks[i] = self._cache[i] = block
+        # Fetch runs of consecutive missing blocks
+        j = 0
+        while j < len(missing):
+            k = j
+            while k + 1 < len(missing) and missing[k + 1] == missing[k] + 1:
+                k += 1
+            blocks.update(self._fetch(missing[j], k - j + 1))
+            j = k + 1
+        data = b''.join(blocks[i] for i in range(first, last + 1))
+        offset = self._pos - first * bs
+        self._pos, pos = end, self._pos
+        return data[offset:offset + end - pos]
+
+
+# %% Incremental decoding
+
+
+class _Incomplete(Exception):
+    """ Raised internally by the incremental decoder when the buffer does not
+    yet hold enough bytes. The ``need`` attribute is the buffer size that is
+    required before it makes sense to try again.
+    """
+
+    def __init__(self, need):
+        Exception.__init__(self)
+        self.need = need
+
+
+class BsdfDecoder(object):
+    """ An incremental (push-style) BSDF decoder, for use with data that
+    arrives in fragments, e.g. from a socket or a message broker.
+
+    Feed arbitrary chunks of bytes with ``feed()``, which returns a list of
+    the objects that were completed by that chunk. The decoder keeps its
+    partial-parse state between calls, and only (temporarily) buffers the
+    bytes of the value that is currently being parsed. Multiple documents
+    (each starting with the BSDF header) can be fed in succession.
+
+    If a document ends with a streamed list, the document is produced as soon
+    as the stream's header is parsed (with a list in place of the stream),
+    after which each stream item is produced as it completes (and also
+    appended to that list). An unclosed stream consumes all further input.
+    See `BsdfSerializer` for details on extensions and options.
+    """
+
+    def __init__(self, extensions=None, **options):
+        self._serializer = BsdfSerializer(extensions, **options)
+        self._buffer = bytearray()
+        self._pos = 0  # Position of the first byte that is not parsed yet
+        self._need = 0  # Buffer size needed to continue parsing
+        self._header_needed = True
+        self._stack = []  # list of [container, remaining, ext_id, key]
+        self._stream = None  # [list, remaining] when in a stream
+        self._results = []
+
+    @property
+    def streaming(self):
+        """ Whether the decoder is currently producing stream items.
+        """
+        return self._stream is not None
+
+    def feed(self, bb):
+        """ Feed a chunk of bytes into the decoder. Returns a (possibly empty)
+        list of top-level objects and stream items completed by this chunk.
+        """
+        self._buffer += bb
+        if len(self._buffer) >= self._need:
+            try:
+                while True:
+                    self._step()
+            except _Incomplete as err:
+                self._need = err.need - self._pos
+            # Drop the parsed bytes
+            del self._buffer[:self._pos]
+            self._pos = 0
+        results, self._results = self._results, []
+        return results
+
+    def close(self):
+        """ Signal that no more data will be fed. Raises EOFError if the
+        fed data ends in the middle of a document.
+        """
+        if self._buffer or self._stack or (self._stream is not None and
+                                           self._stream[1] >= 0):
+            raise EOFError('BSDF data ends in the middle of a document.')
+
+    def _take(self, i, n):
+        """ Get n bytes at position i of the buffer, or raise _Incomplete.
+        """
+        if i + n > len(self._buffer):
+            raise _Incomplete(i + n)
+        return bytes(self._buffer[i:i + n])
+
+    def _take_size(self, i):
+        """ Get a size (lencode) at position i. Returns (size, new_i).
+        """
+        n = strunpack('<B', self._take(i, 1))[0]
+        if n == 253:
+            return strunpack('<Q', self._take(i + 1, 8))[0], i + 9
+        return n, i + 1
+
+    def _step(self):
+        """ Parse one token at the current position; raises _Incomplete
+        when more bytes are needed.
+        """
+        take = self._take
+        i = self._pos
+
+        # Header of a new document
+        if self._header_needed:
+            f4 = take(i, 4)
+            if f4 != b'BSDF':
+                raise RuntimeError('This does not look like a BSDF file: %r'
+                                   % f4)
+            _check_version(*strunpack('<BB', take(i + 4, 2)))
+            self._pos = i + 6
+            self._header_needed = False
+            return
+
+        # Name of the next item in a mapping
+        if self._stack:
+            frame = self._stack[-1]
+            if isinstance(frame[0], dict) and frame[3] is None:
+                n_name, i = self._take_size(i)
+                assert n_name > 0
+                frame[3] = take(i, n_name).decode('UTF-8')
+                self._pos = i + n_name
+                return
+
+        # Get value type
+        char = take(i, 1)
+        c = char.lower()
+        i += 1
+        if char != c:
+            n = strunpack('<B', take(i, 1))[0]
+            ext_id = take(i + 1, n).decode('UTF-8')
+            i += 1 + n
+        else:
+            ext_id = None
+
+        if c == b'v':
+            value = None
+        elif c == b'y':
+            value = True
+        elif c == b'n':
+            value = False
+        elif c == b'h':
+            value = strunpack('<h', take(i, 2))[0]
+            i += 2
+        elif c == b'i':
+            value = strunpack('<q', take(i, 8))[0]
+            i += 8
+        elif c == b'f':
+            value = strunpack('<f', take(i, 4))[0]
+            i += 4
+        elif c == b'd':
+            value = strunpack('<d', take(i, 8))[0]
+            i += 8
+        elif c == b's':
+            n_s, i = self._take_size(i)
+            value = take(i, n_s).decode('UTF-8')
+            i += n_s
+        elif c in b'lm':
+            n = strunpack('<B', take(i, 1))[0]
+            if c == b'l' and n >= 254:
+                # Streaming: the enclosing objects are complete from here
+                closed = n == 254
+                n = strunpack('<Q', take(i + 1, 8))[0]
+                self._pos = i + 9
+                value = []
+                self._add_value(value, ext_id)
+                self._header_needed = False  # the stream items follow
+                self._stream = [value, n if closed else -1]
+                self._end_stream_if_done()
+                return
+            n, i = self._take_size(i)
+            self._pos = i
+            self._stack.append([[] if c == b'l' else {}, n, ext_id, None])
+            self._pop_completed()
+            return
+        elif c == b'b':
+            i0 = i
+            allocated_size, i = self._take_size(i)
+            used_size, i = self._take_size(i)
+            data_size, i = self._take_size(i)
+            has_checksum = strunpack('<B', take(i + 1, 1))[0]
+            i += 2 + (16 if has_checksum else 0)
+            alignment = strunpack('<B', take(i, 1))[0]
+            i += 1 + alignment + allocated_size
+            if i > len(self._buffer):
+                raise _Incomplete(i)
+            blob = Blob((BytesIO(self._buffer[i0:i]), False))
+            value = blob.get_bytes()
+        else:
+            raise RuntimeError('Parse error %r' % char)
+
+        self._pos = i
+        self._add_value(value, ext_id)
+
+    def _add_value(self, value, ext_id):
+        """ Add a completed value to its parent (or produce it).
+        """
+        # Convert value if we have an extension for it
+        if ext_id is not None:
+            extension = self._serializer._extensions.get(ext_id, None)
+            if extension is not None:
+                value = extension.decode(self._serializer, value)
+            else:
+                logger.warn('BSDF warning: no extension found for %r' % ext_id)
+
+        if self._stack:
+            frame = self._stack[-1]
+            if isinstance(frame[0], dict):
+                frame[0][frame[3]] = value
+                frame[3] = None
+            else:
+                frame[0].append(value)
+            frame[1] -= 1
+            self._pop_completed()
+        elif self._stream is not None:
+            # A stream item
+            self._stream[0].append(value)
+            self._results.append(value)
+            if self._stream[1] > 0:
+                self._stream[1] -= 1
+            self._end_stream_if_done()
+        else:
+            # A complete document
+            self._results.append(value)
+            self._header_needed = True
+
+    def _pop_completed(self):
+        """ Finish the container on top of the stack if it's complete.
+        """
+        if self._stack and self._stack[-1][1] == 0:
+            container, _, ext_id, _ = self._stack.pop()
+            self._add_value(container, ext_id)
+
+    def _end_stream_if_done(self):
+        if self._stream[1] == 0:
+            self._stream = None
+            self._header_needed = True
+
+
 # %% High-level functions
 
 
-def encode(ob, extensions=None, **options):
+def encode(ob, extensions=None, buffer_callback=None, **options):
     """ Save (BSDF-encode) the given object to bytes.
-    See `BSDFSerializer` for details on extensions and options.
+    See `BSDFSerializer` for details on extensions and options, and
+    `BsdfSerializer.encode()` for ``buffer_callback``.
     """
     s = BsdfSerializer(extensions, **options)
-    return s.encode(ob)
+    return s.encode(ob, buffer_callback)
 
 
 def save(f, ob, extensions=None, **options):
@@ -789,18 +3632,25 @@ def save(f, ob, extensions=None, **options):
         return s.save(f, ob)
 
 
-def decode(bb, extensions=None, **options):
+def decode(bb, extensions=None, buffers=None, **options):
     """ Load a (BSDF-encoded) structure from bytes.
-    See `BSDFSerializer` for details on extensions and options.
+    See `BSDFSerializer` for details on extensions and options, and
+    `BsdfSerializer.decode()` for ``buffers``.
     """
     s = BsdfSerializer(extensions, **options)
-    return s.decode(bb)
+    return s.decode(bb, buffers)
 
 
-def load(f, extensions=None, **options):
+def load(f, extensions=None, cache=None, **options):
     """ Load a (BSDF-encoded) structure from the given filename or file object.
-    See `BSDFSerializer` for details on extensions and options.
+    See `BSDFSerializer` for details on extensions and options. If a
+    `LoadCache` is given, a file that is loaded again (with the same
+    extensions and options) is only decoded if it has changed.
     """
+    if cache is not None:
+        if not isinstance(f, string_types):
+            raise TypeError('Can only use a load cache with a filename.')
+        return cache._load(f, extensions, options)
     s = BsdfSerializer(extensions, **options)
     if isinstance(f, string_types):
         if f.startswith(('~/', '~\\')):  # pragma: no cover
@@ -811,6 +3661,130 @@ def load(f, extensions=None, **options):
         return s.load(f)
 
 
+def save_all(f, obs, extensions=None, length_prefix=False, **options):
+    """ Save (BSDF-encode) the objects from the given iterable as a sequence
+    of documents to the given filename or file object. See
+    `BsdfSerializer.save_all()` for details on ``length_prefix``, and
+    `BsdfSerializer` for details on extensions and options.
+    """
+    s = BsdfSerializer(extensions, **options)
+    if isinstance(f, string_types):
+        with open(f, 'wb') as fp:
+            return s.save_all(fp, obs, length_prefix)
+    else:
+        return s.save_all(f, obs, length_prefix)
+
+
+def load_all(f, extensions=None, length_prefix=False, skip=None, **options):
+    """ Lazily load a sequence of (BSDF-encoded) documents from the given
+    filename or file object. Returns a generator. See
+    `BsdfSerializer.load_all()` for details on ``length_prefix`` and
+    ``skip``, and `BsdfSerializer` for details on extensions and options.
+    """
+    s = BsdfSerializer(extensions, **options)
+    if isinstance(f, string_types):
+        if f.startswith(('~/', '~\\')):  # pragma: no cover
+            f = os.path.expanduser(f)
+        return _load_all_from_filename(s, f, length_prefix, skip)
+    else:
+        return s.load_all(f, length_prefix, skip)
+
+
+def _load_all_from_filename(s, filename, length_prefix, skip):
+    with open(filename, 'rb') as fp:
+        for ob in s.load_all(fp, length_prefix, skip):
+            yield ob
+
+
+def load_parallel(filename, workers=None, extensions=None, **options):
+    """ Load a (BSDF-encoded) structure from the given filename, decoding the
+    items of its stream (if it has one) in parallel using worker processes.
+    The stream is replaced with a list. See `ListStream.map()` for details,
+    and `BsdfSerializer` for details on extensions and options.
+    """
+    options['load_streaming'] = True
+    s = BsdfSerializer(extensions, **options)
+    if filename.startswith(('~/', '~\\')):  # pragma: no cover
+        filename = os.path.expanduser(filename)
+    with open(filename, 'rb') as fp:
+        ob = s.load(fp)
+        # Find the stream, which is the last object in the structure
+        parent, key, stream = None, None, ob
+        while not isinstance(stream, ListStream):
+            if isinstance(stream, list) and stream:
+                parent, key, stream = stream, -1, stream[-1]
+            elif isinstance(stream, dict) and stream:
+                key = list(stream.keys())[-1]
+                parent, stream = stream, stream[key]
+            else:
+                return ob
+        items = list(stream.map(None, workers))
+        if parent is None:
+            return items
+        parent[key] = items
+        return ob
+
+
+def patch(f, key_path, value, extensions=None, convert=False, **options):
+    """ Overwrite the value at the given key path (a list of keys and indices)
+    in the given filename or file object (opened in 'r+b' mode), without
+    rewriting the rest of the file. See `BsdfSerializer.patch()` for details
+    (also on ``convert``), and `BsdfSerializer` for details on extensions
+    and options.
+    """
+    s = BsdfSerializer(extensions, **options)
+    if isinstance(f, string_types):
+        if f.startswith(('~/', '~\\')):  # pragma: no cover
+            f = os.path.expanduser(f)
+        with open(f, 'r+b') as fp:
+            return s.patch(fp, key_path, value, convert)
+    else:
+        return s.patch(f, key_path, value, convert)
+
+
+def memmap(filename, key_path, mode='r+', extensions=None, **options):
+    """ Get a numpy memmap for the ndarray at the given key path (a list of
+    keys and indices) in the given file, for in-place reading and writing.
+    See `BsdfSerializer.memmap()` for details, and `BsdfSerializer` for
+    details on extensions and options.
+    """
+    s = BsdfSerializer(extensions, **options)
+    if filename.startswith(('~/', '~\\')):  # pragma: no cover
+        filename = os.path.expanduser(filename)
+    return s.memmap(filename, key_path, mode)
+
+
+def open_stream_for_append(filename, extensions=None, **options):
+    """ Open the given file, and get the stream at the end of its structure
+    as a ListStream in write mode, so that more items can be appended to it.
+    Use the stream as a context manager to close the file when done. See
+    `BsdfSerializer.open_stream_for_append()` for details, and
+    `BsdfSerializer` for details on extensions and options.
+    """
+    s = BsdfSerializer(extensions, **options)
+    if filename.startswith(('~/', '~\\')):  # pragma: no cover
+        filename = os.path.expanduser(filename)
+    f = open(filename, 'r+b')
+    try:
+        stream = s.open_stream_for_append(f)
+    except Exception:
+        f.close()
+        raise
+    stream._owns_file = True
+    return stream
+
+
+def recover_stream(filename, extensions=None, **options):
+    """ Recover the stream at the end of the given file, e.g. after a crash:
+    an incomplete item at the end of the file is truncated, and all complete
+    items are marked in the stream's header (closing the stream).
+    Returns the number of items in the stream.
+    """
+    with open_stream_for_append(filename, extensions, **options) as stream:
+        stream.close()
+    return stream.count
+
+
 # Aliases for json compat
 loads = decode
 dumps = encode
@@ -891,9 +3865,16 @@ class NDArrayExtension(Extension):
                 hasattr(v, 'tobytes'))
 
     def encode(self, s, v):
+        np = sys.modules.get('numpy', None)
+        if np is not None and isinstance(v, np.ndarray):
+            # Refer to the data rather than copying it (if contiguous)
+            data = np.ascontiguousarray(v).reshape(-1).view(np.uint8)
+            data = memoryview(data)
+        else:  # pragma: no cover - e.g. other array types
+            data = v.tobytes()
         return dict(shape=v.shape,
                     dtype=text_type(v.dtype),
-                    data=v.tobytes())
+                    data=data)
 
     def decode(self, s, v):
         try:
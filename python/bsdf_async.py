@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# This file is distributed under the terms of the 2-clause BSD License.
+# Copyright (c) 2017-2018, Almar Klein
+
+"""
+Asyncio support for the Python implementation of BSDF.
+
+Provides coroutines to load BSDF-encoded structures from an
+``asyncio.StreamReader`` and to save them to an ``asyncio.StreamWriter``,
+so that many connections can be served from a single event loop. Streamed
+lists are available as ``AsyncListStream`` objects, which support
+``async for`` in read mode and awaitable appends in write mode.
+
+Since readers and writers cannot seek, blobs are always loaded (not lazily),
+and streams that are written cannot be closed; the receiver reads the items
+of an unclosed stream until the connection is closed.
+
+This module requires Python 3.5+.
+"""
+
+import bz2
+import zlib
+
+import bsdf
+from bsdf import strunpack, VERSION
+
+# Blob payloads are read in chunks of this size, so that the reader's
+# buffer stays bounded, also for huge blobs.
+BLOB_CHUNK_SIZE = 2 ** 16
+
+
+class _WriterFile(object):
+    """ File-like object that collects the bytes written by the encoder,
+    to be passed on to an asyncio StreamWriter.
+    """
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._chunks = []
+        self._pos = 0
+
+    @property
+    def closed(self):
+        return self._writer.transport.is_closing()
+
+    def write(self, bb):
+        self._chunks.append(bb)
+        self._pos += len(bb)
+
+    def tell(self):
+        return self._pos
+
+    async def flush(self):
+        chunks, self._chunks = self._chunks, []
+        self._writer.writelines(chunks)
+        await self._writer.drain()
+
+
+class AsyncBsdfSerializer(bsdf.BsdfSerializer):
+    """ A BSDF serializer that can also load from an asyncio StreamReader
+    and save to an asyncio StreamWriter. See `BsdfSerializer` for details
+    on extensions and options. The ``lazy_blob`` option is ignored by the
+    async methods.
+    """
+
+    async def _decode_async(self, reader):
+        """ Main async decoder function.
+        """
+
+        # Get value
+        char = await reader.read(1)
+        c = char.lower()
+
+        # Conversion (uppercase value identifiers signify converted values)
+        if not char:
+            raise EOFError()
+        elif char != c:
+            n = strunpack('<B', await reader.readexactly(1))[0]
+            ext_id = (await reader.readexactly(n)).decode('UTF-8')
+        else:
+            ext_id = None
+
+        if c == b'v':
+            value = None
+        elif c == b'y':
+            value = True
+        elif c == b'n':
+            value = False
+        elif c == b'h':
+            value = strunpack('<h', await reader.readexactly(2))[0]
+        elif c == b'i':
+            value = strunpack('<q', await reader.readexactly(8))[0]
+        elif c == b'f':
+            value = strunpack('<f', await reader.readexactly(4))[0]
+        elif c == b'd':
+            value = strunpack('<d', await reader.readexactly(8))[0]
+        elif c == b's':
+            n_s = await _lendecode(reader)
+            value = (await reader.readexactly(n_s)).decode('UTF-8')
+        elif c == b'l':
+            n = strunpack('<B', await reader.readexactly(1))[0]
+            if n >= 254:
+                # Streaming
+                closed = n == 254
+                n = strunpack('<Q', await reader.readexactly(8))[0]
+                if self._load_streaming:
+                    value = AsyncListStream(n if closed else 'r')
+                    value._activate(reader, self._encode, self._decode_async)
+                elif closed:
+                    value = [await self._decode_async(reader)
+                             for i in range(n)]
+                else:
+                    value = []
+                    try:
+                        while True:
+                            value.append(await self._decode_async(reader))
+                    except EOFError:
+                        pass
+            else:
+                # Normal
+                if n == 253:
+                    n = strunpack('<Q', await reader.readexactly(8))[0]
+                value = [await self._decode_async(reader) for i in range(n)]
+        elif c == b'm':
+            value = dict()
+            n = await _lendecode(reader)
+            for i in range(n):
+                n_name = await _lendecode(reader)
+                assert n_name > 0
+                name = (await reader.readexactly(n_name)).decode('UTF-8')
+                value[name] = await self._decode_async(reader)
+        elif c == b'b':
+            value = await _read_blob(reader)
+        else:
+            raise RuntimeError('Parse error %r' % char)
+
+        # Convert value if we have an extension for it
+        if ext_id is not None:
+            extension = self._extensions.get(ext_id, None)
+            if extension is not None:
+                value = extension.decode(self, value)
+            else:
+                bsdf.logger.warning('BSDF warning: no extension found for %r'
+                                    % ext_id)
+
+        return value
+
+    async def save_async(self, writer, ob):
+        """ Write the given object to the given asyncio StreamWriter.
+        If the object contains a stream, it must be an `AsyncListStream`.
+        """
+        # Check the stream (if any) before it is activated
+        last = ob
+        while isinstance(last, (list, tuple, dict)) and len(last) > 0:
+            last = list(last.values())[-1] if isinstance(last, dict) \
+                else last[-1]
+        if (isinstance(last, bsdf.BaseStream) and
+                not isinstance(last, AsyncListStream)):
+            raise TypeError('Can only save an AsyncListStream '
+                            'to an asyncio writer.')
+        f = _WriterFile(writer)
+        streams = []
+        f.write(b'BSDF')
+        f.write(bsdf.spack('<BB', VERSION[0], VERSION[1]))
+        self._encode(f, ob, streams, None)
+        if len(streams) > 0:
+            stream = streams[0]
+            if not isinstance(stream, AsyncListStream):
+                raise TypeError('Can only save an AsyncListStream '
+                                'to an asyncio writer.')
+            if stream._start_pos != f.tell():
+                raise ValueError('The stream object must be '
+                                 'the last object to be encoded.')
+        await f.flush()
+
+    async def load_async(self, reader):
+        """ Load a BSDF-encoded object from the given asyncio StreamReader.
+        """
+        # Check magic string
+        f4 = await reader.readexactly(4)
+        if f4 != b'BSDF':
+            raise RuntimeError('This does not look like a BSDF file: %r' % f4)
+        # Check version
+        bsdf._check_version(*strunpack('<BB', await reader.readexactly(2)))
+        return await self._decode_async(reader)
+
+
+class AsyncListStream(bsdf.ListStream):
+    """ A streamable list object for use with asyncio readers and writers.
+    In read mode, items can be obtained with ``await stream.next()`` or
+    ``async for item in stream``. In write mode, use
+    ``await stream.append(item)``.
+    """
+
+    def _activate(self, file, encode_func, decode_func):
+        if self._f is not None:  # Associated with another write
+            raise IOError('Stream object cannot be activated twice?')
+        self._f = file
+        self._start_pos = file.tell() if hasattr(file, 'tell') else 0
+        self._encode = encode_func
+        self._decode = decode_func
+
+    async def append(self, item):
+        """ Append an item to the streaming list. The object is serialized
+        and written to the underlying writer.
+        """
+        if self._count != self._i:
+            raise IOError('Can only append items to the end of the stream.')
+        if self._f is None:
+            raise IOError('List stream is not associated with a writer yet.')
+        if self._f.closed:
+            raise IOError('Cannot stream to a closed writer.')
+        self._encode(self._f, item, [self], None)
+        self._i += 1
+        self._count += 1
+        await self._f.flush()
+
+    def close(self, unstream=False):
+        """ Asyncio writers cannot seek, so the stream cannot be closed.
+        The receiver reads items until the connection is closed.
+        """
+        raise IOError('Cannot close a stream on an asyncio writer.')
+
+    async def next(self):
+        """ Read and return the next element in the streaming list.
+        Raises StopAsyncIteration if the stream is exhausted.
+        """
+        if self._mode != 'r':
+            raise IOError('This ListStream in not in read mode.')
+        if self._f is None:
+            raise IOError('ListStream is not associated with a reader yet.')
+        if self._count >= 0:
+            if self._i >= self._count:
+                raise StopAsyncIteration()
+            self._i += 1
+            return await self._decode(self._f)
+        else:
+            try:
+                res = await self._decode(self._f)
+                self._i += 1
+                return res
+            except EOFError:
+                self._count = self._i
+                raise StopAsyncIteration()
+
+    def __iter__(self):
+        raise TypeError('Use "async for" to iterate over an AsyncListStream.')
+
+    def __aiter__(self):
+        if self._mode != 'r':
+            raise IOError('Cannot iterate: ListStream in not in read mode.')
+        return self
+
+    async def __anext__(self):
+        return await self.next()
+
+
+async def _lendecode(reader):
+    """ Decode an unsigned integer from an asyncio reader.
+    """
+    n = strunpack('<B', await reader.readexactly(1))[0]
+    if n == 253:
+        n = strunpack('<Q', await reader.readexactly(8))[0]
+    return n
+
+
+async def _read_blob(reader):
+    """ Read a blob from an asyncio reader and return its contents as bytes.
+    """
+    # Read blob header data
+    allocated_size = await _lendecode(reader)
+    used_size = await _lendecode(reader)
+    await _lendecode(reader)  # data_size
+    compression, has_checksum = strunpack('<BB', await reader.readexactly(2))
+    if has_checksum:
+        await reader.readexactly(16)
+    alignment = strunpack('<B', await reader.readexactly(1))[0]
+    await reader.readexactly(alignment)
+    # Read data in bounded chunks, then skip the extra space
+    compressed = bytearray()
+    while len(compressed) < used_size:
+        n = min(BLOB_CHUNK_SIZE, used_size - len(compressed))
+        compressed += await reader.readexactly(n)
+    n_extra = allocated_size - used_size
+    while n_extra > 0:
+        n_extra -= len(await reader.readexactly(min(BLOB_CHUNK_SIZE,
+                                                    n_extra)))
+    # Decompress
+    if compression == 0:
+        return bytes(compressed)
+    elif compression == 1:
+        return zlib.decompress(compressed)
+    elif compression == 2:
+        return bz2.decompress(compressed)
+    else:
+        raise RuntimeError('Invalid compression %i' % compression)
+
+
+async def save(writer, ob, extensions=None, **options):
+    """ Save (BSDF-encode) the given object to the given asyncio StreamWriter.
+    See `BsdfSerializer` for details on extensions and options.
+    """
+    s = AsyncBsdfSerializer(extensions, **options)
+    return await s.save_async(writer, ob)
+
+
+async def load(reader, extensions=None, **options):
+    """ Load a (BSDF-encoded) structure from the given asyncio StreamReader.
+    See `BsdfSerializer` for details on extensions and options.
+    """
+    s = AsyncBsdfSerializer(extensions, **options)
+    return await s.load_async(reader)
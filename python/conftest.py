@@ -0,0 +1,11 @@
+"""
+Pytest configuration for the Python implementation of BSDF.
+"""
+
+import sys
+
+collect_ignore = []
+
+# The asyncio support uses "async def", which older Pythons cannot compile
+if sys.version_info < (3, 5):
+    collect_ignore.append('test_async.py')
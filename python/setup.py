@@ -4,6 +4,7 @@ except ImportError:
     from distutils.core import setup  # Supports anything else
 
 import os
+import sys
 
 
 version = None
@@ -24,6 +25,11 @@ for line in open(fname, 'rb').read().decode('utf-8').splitlines():
 assert version, 'could not find version'
 assert doc, 'could not find docs'
 
+# The asyncio support (bsdf_async) needs Python 3.5+
+py_modules = ['bsdf', 'bsdf_cli']
+if sys.version_info >= (3, 5):
+    py_modules.append('bsdf_async')
+
 
 setup(name='bsdf',
     version=version,
@@ -32,7 +38,7 @@ setup(name='bsdf',
     author='Almar Klein',
     author_email='almar.klein@gmail.com',
     url='http://bsdf.io',
-    py_modules=['bsdf', 'bsdf_cli'],
+    py_modules=py_modules,
     install_requires = [],
     python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*',
     platforms = 'any',
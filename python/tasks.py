@@ -17,7 +17,7 @@ def call(*cmd):
 def lint(ctx):
     """ Run style tests with flake8. """
     # Print nice messages when all is well; flake8 does not celebrate.
-    ret_code = subprocess.call(['flake8', 'bsdf.py', 'bsdf_cli.py', '--ignore=S1'], cwd=this_dir)
+    ret_code = subprocess.call(['flake8', 'bsdf.py', 'bsdf_cli.py', 'bsdf_async.py', '--ignore=S1'], cwd=this_dir)
     if ret_code == 0:
         print('No style errors found')
     sys.exit(ret_code)
@@ -25,7 +25,7 @@ def lint(ctx):
 @task
 def test_unit(ctx):
     """ Run all unit tests with pytest. """
-    call('pytest', '-v', '-x', '--cov', 'bsdf', '--cov', 'bsdf_cli', '--cov-report', 'html', '.')
+    call('pytest', '-v', '-x', '--cov', 'bsdf', '--cov', 'bsdf_cli', '--cov', 'bsdf_async', '--cov-report', 'html', '.')
 
 @task
 def test_shared(ctx, exe=sys.executable):
@@ -77,8 +77,14 @@ def _get_reference():
     parts = []
 
     for ob in (bsdf.encode, bsdf.decode, bsdf.save, bsdf.load,
+               bsdf.save_all, bsdf.load_all, bsdf.load_parallel,
+               bsdf.patch, bsdf.memmap, bsdf.open_stream_for_append,
+               bsdf.recover_stream,
                bsdf.BsdfSerializer, bsdf.Extension,
-               bsdf.ListStream, bsdf.Blob):
+               bsdf.ListStream, bsdf.StreamAppender, bsdf.Blob,
+               bsdf.BlobCache, bsdf.LoadCache, bsdf.FilePool,
+               bsdf.HttpRangeFile, bsdf.SharedMemoryMessage,
+               bsdf.BsdfDecoder):
 
         sig = str(inspect.signature(ob))
         if isinstance(ob, type):
@@ -0,0 +1,174 @@
+"""
+Test the asyncio support of this BSDF implementation.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import io
+import sys
+import socket
+import asyncio
+
+from pytest import raises, skip
+
+if sys.version_info < (3, 5):
+    skip('asyncio support needs Python 3.5+', allow_module_level=True)
+
+import bsdf
+import bsdf_async
+
+
+loop = None
+
+
+def setup_module():
+    global loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+
+def teardown_module():
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def run(coro):
+    return loop.run_until_complete(coro)
+
+
+def make_reader(bb):
+    reader = asyncio.StreamReader()
+    reader.feed_data(bb)
+    reader.feed_eof()
+    return reader
+
+
+def make_connection():
+    """ Get a (reader, writer) pair that are connected via a socket pair.
+    """
+    s1, s2 = socket.socketpair()
+    reader, writer1 = run(asyncio.open_connection(sock=s1))
+    reader2, writer = run(asyncio.open_connection(sock=s2))
+    reader._keep_alive = writer1  # prevent closing the socket on gc
+    return reader, writer
+
+
+def test_async_load():
+
+    data = dict(foo=42, bar=[1, 2.1, False, None, 'spam', b'eggs'], c=3+4j)
+    for compression in (0, 1, 2):
+        bb = bsdf.encode(data, compression=compression, use_checksum=True)
+        assert run(bsdf_async.load(make_reader(bb))) == data
+
+    # Large blob is read in chunks
+    data = [b'x' * (3 * bsdf_async.BLOB_CHUNK_SIZE + 7), 3]
+    bb = bsdf.encode(bsdf.Blob(data[0], extra_size=100000)) + b'trailing'
+    reader = make_reader(bb)
+    assert run(bsdf_async.load(reader)) == data[0]
+    assert run(reader.read()) == b'trailing'
+
+    # Not BSDF
+    with raises(RuntimeError):
+        run(bsdf_async.load(make_reader(b'BZDF\x02\x00v')))
+    # Truncated
+    with raises(EOFError):
+        run(bsdf_async.load(make_reader(bsdf.encode([1, 2, 3])[:-2])))
+
+
+def test_async_save():
+
+    data = dict(foo=42, bar=[1, 2.1, False, None, 'spam', b'eggs'], c=3+4j)
+    reader, writer = make_connection()
+    run(bsdf_async.save(writer, data, compression=1))
+    writer.close()
+    assert run(bsdf_async.load(reader)) == data
+
+    # Byte-identical to sync encoding
+    reader, writer = make_connection()
+    run(bsdf_async.save(writer, data))
+    writer.close()
+    assert run(reader.read()) == bsdf.encode(data)
+
+
+def test_async_liststream():
+
+    reader, writer = make_connection()
+
+    # Only async streams, which are not activated otherwise
+    ls = bsdf.ListStream()
+    with raises(TypeError):
+        run(bsdf_async.save(writer, [3, ls]))
+    f = io.BytesIO()
+    bsdf.save(f, [3, ls])
+
+    ls = bsdf_async.AsyncListStream()
+    run(bsdf_async.save(writer, [3, 4, ls]))
+    for i in range(5):
+        run(ls.append(i * 101))
+    run(ls.append('hi'))
+    assert ls.count == 6
+    with raises(IOError):
+        ls.close()
+
+    # Read while the connection is still open
+    res = run(bsdf_async.load(reader, load_streaming=True))
+    x = res[-1]
+    assert isinstance(x, bsdf_async.AsyncListStream)
+    assert run(x.next()) == 0
+    assert run(x.next()) == 101
+    with raises(TypeError):
+        iter(x)
+
+    # Read remaining items using async iteration
+    writer.close()
+
+    async_iter = x.__aiter__()
+    items = []
+    while True:
+        try:
+            items.append(run(async_iter.__anext__()))
+        except StopAsyncIteration:
+            break
+    assert items == [202, 303, 404, 'hi']
+    assert x.count == 6
+
+
+def test_async_liststream_closed():
+
+    # Closed stream
+    ls = bsdf.ListStream()
+    f = bsdf.BytesIO()
+    bsdf.save(f, [3, ls])
+    ls.append(1)
+    ls.append(2)
+    ls.close()
+    ls.append(3)
+    bb = f.getvalue()
+
+    assert run(bsdf_async.load(make_reader(bb))) == [3, [1, 2]]
+    res = run(bsdf_async.load(make_reader(bb), load_streaming=True))
+    assert run(res[1].next()) == 1
+    assert run(res[1].next()) == 2
+    with raises(StopAsyncIteration):
+        run(res[1].next())
+
+    # Unclosed stream, without load_streaming
+    ls = bsdf.ListStream()
+    f = bsdf.BytesIO()
+    bsdf.save(f, [3, ls])
+    ls.append(1)
+    ls.append(2)
+    assert run(bsdf_async.load(make_reader(f.getvalue()))) == [3, [1, 2]]
+
+
+if __name__ == '__main__':
+
+    for name, func in list(globals().items()):
+        if name.startswith('test_'):
+            print('Running %s ' % name, end='')
+            try:
+                func()
+            except Exception:
+                print('  Failed')
+                raise
+            print('  Passed')
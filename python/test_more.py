@@ -10,7 +10,9 @@ import os
 import io
 import sys
 import array
+import struct
 import tempfile
+from collections import OrderedDict
 
 from pytest import raises, skip
 
@@ -248,6 +250,604 @@ def test_liststream_modding():
     assert bsdf.load(tempfilename) == ['foo', 'bar', None, 42, 4, 5]
 
 
+def test_liststream_map():
+
+    # Create a file
+    for closed in (False, True):
+        ls = bsdf.ListStream()
+        with open(tempfilename, 'wb') as f:
+            bsdf.save(f, dict(foo=3, bar=[4, ls]))
+            for i in range(1000):
+                ls.append([i, 'x' * (i % 10), b'y' * i])
+            if closed:
+                ls.close()
+                ls.append('not read')
+
+        expected = [[i, 'x' * (i % 10), b'y' * i] for i in range(1000)]
+
+        # Load in parallel
+        res = bsdf.load_parallel(tempfilename, workers=2)
+        assert res == dict(foo=3, bar=[4, expected])
+
+        # Map, ordered and unordered
+        with open(tempfilename, 'rb') as f:
+            ls = bsdf.load(f, load_streaming=True)['bar'][1]
+            assert ls.next() == expected[0]
+            res = list(ls.map(len, 3, chunk_size=1000))
+            assert res == [3] * 999
+            assert ls.index == ls.count == 1000
+        with open(tempfilename, 'rb') as f:
+            ls = bsdf.load(f, load_streaming=True)['bar'][1]
+            res = list(ls.map(repr, 3, ordered=False, chunk_size=1000))
+            assert sorted(res) == sorted(repr(x) for x in expected)
+
+    # Without a stream
+    bsdf.save(tempfilename, [1, 2, [3, 4]])
+    assert bsdf.load_parallel(tempfilename) == [1, 2, [3, 4]]
+    ls = bsdf.ListStream()
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, ls)
+        ls.append(3)
+    assert bsdf.load_parallel(tempfilename) == [3]
+
+    # Fails
+    with raises(IOError):
+        next(bsdf.ListStream().map())
+    with raises(IOError):
+        next(bsdf.ListStream('r').map())
+    ls = bsdf.decode(bsdf.encode(bsdf.ListStream()), load_streaming=True)
+    with raises(IOError):
+        next(ls.map())
+
+
+def test_serializer_pickle():
+    import pickle
+
+    s1 = bsdf.BsdfSerializer([bsdf.ComplexExtension], compression='zlib')
+    s2 = pickle.loads(pickle.dumps(s1))
+    assert list(s2._extensions.keys()) == ['c']
+    assert s2._compression == 1
+    assert s2.encode([3 + 4j, b'x']) == s1.encode([3 + 4j, b'x'])
+
+
+def _stream_appender_worker(args):
+    filename, j = args
+    with bsdf.StreamAppender(filename, batch_size=7) as appender:
+        for i in range(100):
+            appender.append([j, i, 'x' * i])
+    return j
+
+
+def test_stream_appender():
+    try:
+        import fcntl  # noqa
+    except ImportError:
+        skip('need fcntl')
+    import multiprocessing
+
+    ls = bsdf.ListStream()
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, OrderedDict([('meta', 'foo'), ('items', ls)]))
+        ls.append([0, 0, ''])
+    with open(tempfilename, 'ab') as f:
+        f.write(b'h\x00')  # torn item is removed on opening
+
+    # Single process, with explicit and automatic flushes
+    with bsdf.StreamAppender(tempfilename, batch_size=3) as appender:
+        appender.append([0, 1, 'x'])
+        appender.flush()
+        assert bsdf.load(tempfilename)['items'] == [[0, 0, ''], [0, 1, 'x']]
+        appender.append([0, 2, 'xx'])
+        appender.append([0, 3, 'xxx'])
+        appender.append([0, 4, 'xxxx'])
+        assert len(bsdf.load(tempfilename)['items']) == 5
+        appender.append([0, 5, 'xxxxx'])
+        assert len(bsdf.load(tempfilename)['items']) == 5
+        with raises(ValueError):
+            appender.append(bsdf.ListStream())
+    assert appender.closed
+    with raises(IOError):
+        appender.append(3)
+    ob = bsdf.load(tempfilename, load_streaming=True)
+    assert ob['items'].count == 6
+
+    # Multiple processes
+    pool = multiprocessing.Pool(4)
+    try:
+        pool.map(_stream_appender_worker,
+                 [(tempfilename, j) for j in range(1, 5)])
+    finally:
+        pool.close()
+        pool.join()
+    items = bsdf.load(tempfilename)['items']
+    assert len(items) == 6 + 400
+    for j in range(1, 5):
+        assert [item for item in items if item[0] == j] == \
+            [[j, i, 'x' * i] for i in range(100)]
+
+    # Items committed by others are skipped, and torn bytes of a process
+    # that crashed while writing are truncated
+    with bsdf.StreamAppender(tempfilename) as appender:
+        with bsdf.StreamAppender(tempfilename) as appender2:
+            appender2.append('a')
+        with open(tempfilename, 'ab') as f:
+            f.write(b's\x10ab')
+        appender.append('b')
+        appender.append('c')
+    items = bsdf.load(tempfilename)['items']
+    assert len(items) == 6 + 400 + 3
+    assert items[-3:] == ['a', 'b', 'c']
+
+    # Blobs are aligned to their position in the file
+    ls = bsdf.ListStream()
+    bsdf.save(tempfilename, [ls])
+    with bsdf.StreamAppender(tempfilename, batch_size=2) as appender:
+        for i in range(5):
+            appender.append([i, b'x' * (i + 1)])
+    with open(tempfilename, 'rb') as f:
+        items = bsdf.load(f, lazy_blob=True)[0]
+        assert [item[1].get_bytes() for item in items] == \
+            [b'x' * (i + 1) for i in range(5)]
+        assert [item[1].start_pos % 8 for item in items] == [0] * 5
+
+    # Needs a stream
+    bsdf.save(tempfilename, [1, 2])
+    with raises(ValueError):
+        bsdf.StreamAppender(tempfilename)
+
+
+## Incremental decoding
+
+
+def test_incremental_decoder():
+
+    data = [dict(foo=42, bar=[1, 2.1, False, None, 'spam' * 100], e={},
+                 c=3 + 4j, l=[[]]),
+            b'eggs' * 1000, 'x' * 300, 1e300]
+    bb = b''.join(bsdf.encode(d, compression=i % 3, use_checksum=True)
+                  for i, d in enumerate(data))
+
+    # Any fragmentation gives the same result
+    for chunk_size in (1, 3, 7, 100, len(bb)):
+        decoder = bsdf.BsdfDecoder()
+        res = []
+        for i in range(0, len(bb), chunk_size):
+            res.extend(decoder.feed(bb[i:i + chunk_size]))
+        decoder.close()
+        assert res == data
+
+    # Results are produced as soon as they are complete
+    decoder = bsdf.BsdfDecoder()
+    bb1, bb2 = bsdf.encode(3), bsdf.encode('foo')
+    assert decoder.feed(bb1 + bb2[:-1]) == [3]
+    assert decoder.feed(bb2[-1:]) == ['foo']
+
+    # Incomplete data
+    decoder = bsdf.BsdfDecoder()
+    assert decoder.feed(bb[:20]) == []
+    with raises(EOFError):
+        decoder.close()
+
+    # Invalid data
+    with raises(RuntimeError):
+        bsdf.BsdfDecoder().feed(b'BZDF\x02\x00v')
+    with raises(RuntimeError):
+        bsdf.BsdfDecoder().feed(b'BSDF\x02\x00r')
+
+    # Options and extensions are used
+    decoder = bsdf.BsdfDecoder([])
+    assert decoder.feed(bsdf.encode(3 + 4j)) == [[3.0, 4.0]]
+
+
+def test_incremental_decoder_streaming():
+
+    for closed in (False, True):
+        f = io.BytesIO()
+        ls = bsdf.ListStream()
+        bsdf.save(f, [3, {'a': ls}])
+        ls.append(1)
+        ls.append('x')
+        if closed:
+            ls.close()
+        bb = f.getvalue()
+
+        decoder = bsdf.BsdfDecoder()
+        res = [decoder.feed(bb[i:i + 1]) for i in range(len(bb))]
+        res = [r for r in res if r]
+        assert res[1:] == [[1], ['x']]
+        assert res[0] == [[3, {'a': [1, 'x']}]]
+
+        if closed:
+            # A closed stream ends the document
+            assert not decoder.streaming
+            assert decoder.feed(bsdf.encode(7)) == [7]
+        else:
+            assert decoder.streaming
+            assert decoder.feed(b'h\x07\x00') == [7]
+        decoder.close()
+
+
+## In-place editing
+
+
+def test_patch():
+
+    data = dict(status='running', progress=0.0, count=3, big=2**40,
+                flag=False, items=[1, None, [2, 3.5, 'abc']],
+                c=3 + 4j, blob=bsdf.Blob(b'xxyy', extra_size=4,
+                                         use_checksum=True))
+    bsdf.save(tempfilename, data, float64=False)
+    data['blob'] = b'xxyy'
+
+    # Changing the type needs convert=True
+    patches = [('progress', 0.5), ('count', 7), ('count', -30000),
+               ('big', 3), ('big', 2.5, True), ('flag', True),
+               ('flag', None, True), ('status', 'done!!!'),
+               (['items', 1], False, True),
+               (['items', -1, 0], 4), (('items', 2, 1), 1.5),
+               (['items', 2, 2], 'xyz'), ('c', 1 - 1j),
+               ('blob', b'abcdef'), ('blob', b'')]
+    for patch in patches:
+        key_path, value = patch[:2]
+        if len(patch) == 3:
+            with raises(ValueError):
+                bsdf.patch(tempfilename, key_path, value, float64=False)
+        bsdf.patch(tempfilename, key_path, value, float64=False,
+                   convert=len(patch) == 3)
+        if isinstance(key_path, str):
+            data[key_path] = value
+        else:
+            d = data
+            for key in key_path[:-1]:
+                d = d[key]
+            d[key_path[-1]] = value
+        assert bsdf.load(tempfilename) == data
+
+    # Using a file object
+    with open(tempfilename, 'r+b') as f:
+        bsdf.patch(f, 'count', 8)
+    data['count'] = 8
+    assert bsdf.load(tempfilename) == data
+
+    # Incompatible widths
+    for key_path, value in [('count', 2**40), ('status', 'foo'),
+                            ('flag', 3), ('progress', 3), ('items', []),
+                            ('blob', b'x' * 9)]:
+        with raises(ValueError):
+            bsdf.patch(tempfilename, key_path, value, float64=False,
+                       convert=True)
+    # Incompatible types, also of the same width
+    for key_path, value in [('big', 3), ('status', b'foo'), ('status', None),
+                            ('c', [1, 2]), ('count', 3.5), ('progress', 1),
+                            ('count', True)]:
+        with raises(ValueError):
+            bsdf.patch(tempfilename, key_path, value, float64=False)
+    # Invalid paths
+    with raises(KeyError):
+        bsdf.patch(tempfilename, 'foo', 3)
+    with raises(IndexError):
+        bsdf.patch(tempfilename, ['items', 3], 3)
+    with raises(IndexError):
+        bsdf.patch(tempfilename, ['items', -4], 3)
+    with raises(TypeError):
+        bsdf.patch(tempfilename, ['items', 'x'], 3)
+    with raises(TypeError):
+        bsdf.patch(tempfilename, [0], 3)
+    with raises(TypeError):
+        bsdf.patch(tempfilename, ['count', 0], 3)
+
+    assert bsdf.load(tempfilename) == data
+
+    # Into a compressed blob
+    bsdf.save(tempfilename, [b'xx'], compression=1)
+    with raises(ValueError):
+        bsdf.patch(tempfilename, [0], b'yy')
+
+    # Into a stream
+    ls = bsdf.ListStream()
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, [0, ls])
+        ls.append(1)
+        ls.append(2)
+    bsdf.patch(tempfilename, [1, 1], 3)
+    with raises(IndexError):
+        bsdf.patch(tempfilename, [1, 2], 3)
+    assert bsdf.load(tempfilename) == [0, [1, 3]]
+
+
+def test_patch_ndarray():
+    try:
+        import numpy as np
+    except ImportError:
+        skip('need numpy')
+
+    a1 = np.arange(12, dtype='float32').reshape(3, 4)
+    a2 = np.arange(6, dtype='uint8')
+    data = dict(weights=[a1, a2], step=3)
+
+    for use_checksum in (False, True):
+        bsdf.save(tempfilename, data, use_checksum=use_checksum)
+
+        # Patch
+        bsdf.patch(tempfilename, ['weights', 0], a1 * 2)
+        bsdf.patch(tempfilename, ['weights', 1], a2[::-1])
+        res = bsdf.load(tempfilename)
+        assert np.all(res['weights'][0] == a1 * 2)
+        assert np.all(res['weights'][1] == a2[::-1])
+        assert res['step'] == 3
+
+        # Fails
+        for value in (a1.astype('float64'), a1.reshape(4, 3), a2):
+            with raises(ValueError):
+                bsdf.patch(tempfilename, ['weights', 0], value)
+        with raises(TypeError):
+            bsdf.memmap(tempfilename, ['step'])
+
+        # Memmap
+        m = bsdf.memmap(tempfilename, ['weights', 0], 'r')
+        assert m.shape == (3, 4) and np.all(m == a1 * 2)
+        del m
+        if use_checksum:
+            with raises(ValueError):
+                bsdf.memmap(tempfilename, ['weights', 0])
+        else:
+            m = bsdf.memmap(tempfilename, ['weights', 0])
+            m[1] = 42
+            m.flush()
+            del m
+            res = bsdf.load(tempfilename)
+            assert res['weights'][0][1].tolist() == [42] * 4
+
+    # Compressed arrays
+    bsdf.save(tempfilename, data, compression=1)
+    with raises(ValueError):
+        bsdf.patch(tempfilename, ['weights', 1], a2)
+    with raises(ValueError):
+        bsdf.memmap(tempfilename, ['weights', 1])
+
+
+def test_open_stream_for_append():
+
+    ls = bsdf.ListStream()
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, dict(foo=[1, 2], bar={'spam': [3, ls]}))
+        ls.append('a')
+        ls.append(b'b' * 100)
+
+    expected = dict(foo=[1, 2], bar={'spam': [3, ['a', b'b' * 100]]})
+    assert bsdf.load(tempfilename) == expected
+
+    # Append
+    with bsdf.open_stream_for_append(tempfilename) as ls:
+        assert ls.count == ls.index == 2
+        ls.append('c')
+    assert ls._f.closed
+    expected['bar']['spam'][1].append('c')
+    assert bsdf.load(tempfilename) == expected
+
+    # Append and close
+    with bsdf.open_stream_for_append(tempfilename) as ls:
+        ls.append(4)
+        ls.close()
+        ls.append('not read')
+    expected['bar']['spam'][1].append(4)
+    assert bsdf.load(tempfilename) == expected
+    assert bsdf.load(tempfilename, load_streaming=True)['bar']['spam'][1].count == 4
+
+    # Re-opening includes items after close
+    with bsdf.open_stream_for_append(tempfilename) as ls:
+        assert ls.count == 5
+    expected['bar']['spam'][1].append('not read')
+    assert bsdf.load(tempfilename) == expected
+
+    # Torn items are truncated
+    for torn in [b'd', b'h\x00', b's\x05abc', b'l\x03h\x00\x00',
+                 bsdf.encode(b'x' * 100)[6:-10], b'\x00\x00\x00']:
+        with open(tempfilename, 'ab') as f:
+            f.write(torn)
+        with bsdf.open_stream_for_append(tempfilename) as ls:
+            assert ls.count == 5
+        assert bsdf.load(tempfilename) == expected
+    with bsdf.open_stream_for_append(tempfilename) as ls:
+        ls.append(6)
+    expected['bar']['spam'][1].append(6)
+    assert bsdf.load(tempfilename) == expected
+
+    # Stream at the root
+    ls = bsdf.ListStream()
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, ls)
+    with bsdf.open_stream_for_append(tempfilename) as ls:
+        ls.append(1)
+    assert bsdf.load(tempfilename) == [1]
+
+    # A count in the header that includes missing items is corrected
+    with open(tempfilename, 'r+b') as f:
+        f.seek(8)
+        f.write(struct.pack('<Q', 3))
+    with bsdf.open_stream_for_append(tempfilename) as ls:
+        assert ls.count == 1
+        ls.append(2)
+    assert bsdf.load(tempfilename) == [1, 2]
+
+    # No stream
+    for ob in ([1, 2], {}, [], [1, [2, 3]], 3):
+        bsdf.save(tempfilename, ob)
+        with raises(ValueError):
+            bsdf.open_stream_for_append(tempfilename)
+    ls = bsdf.ListStream()
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, ls)
+        ls.close(True)
+    with raises(ValueError):
+        bsdf.open_stream_for_append(tempfilename)
+
+
+def test_liststream_background_writer():
+    import threading
+
+    # Items are written by a background thread
+    ls = bsdf.ListStream(queue_size=4)
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, OrderedDict([('a', 1), ('items', ls)]))
+        ls.append(3)
+        ls.append(bsdf.Blob(b'xx' * 10))  # blob alignment is correct
+        ls.flush()
+        assert ls._writer.is_alive()
+        with open(tempfilename, 'rb') as f2:
+            ob = bsdf.load(f2, load_streaming=True)
+            assert list(ob['items']) == [3, b'xx' * 10]
+        for i in range(100):
+            ls.append(i)
+        ls.close()
+        assert ls._writer is None
+        assert bsdf.load(tempfilename)['items'] == [3, b'xx' * 10] + \
+            list(range(100))
+        # Invalid items do not break the stream
+        with raises(ValueError):
+            ls.append(bsdf.ListStream())
+        ls.append(100)
+        ls.close()
+    assert len(bsdf.load(tempfilename)['items']) == 103
+
+    # From many threads, with checkpoints
+    ls = bsdf.ListStream(queue_size=8, sync_items=10)
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, ls)
+
+        def appender(j):
+            for i in range(50):
+                ls.append(j * 100 + i)
+
+        threads = [threading.Thread(target=appender, args=(j, ))
+                   for j in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ls.close()
+    items = bsdf.load(tempfilename)
+    assert sorted(items) == sorted(j * 100 + i
+                                   for j in range(4) for i in range(50))
+
+    # Errors in the writer thread are raised on the next call
+    class FailingFile(object):
+        """ Proxy for a file, of which writes can be made to fail. """
+        fail = False
+
+        def __init__(self, f):
+            self._f = f
+
+        def __getattr__(self, name):
+            return getattr(self._f, name)
+
+        def write(self, bb):
+            if self.fail:
+                raise IOError('disk full')
+            return self._f.write(bb)
+
+    ls = bsdf.ListStream(queue_size=2)
+    with open(tempfilename, 'wb') as f:
+        f = FailingFile(f)
+        bsdf.save(f, ls)
+        ls.append(1)
+        ls.flush()
+        f.fail = True
+        ls.append(2)
+        with raises(IOError):
+            ls.flush()
+        with raises(IOError):
+            ls.append(3)
+
+
+def test_liststream_durability():
+    import time
+
+    def header_count():
+        with open(tempfilename, 'rb') as f:
+            bb = f.read()
+        if len(bb) < 16:
+            return None  # header not on disk yet
+        ls = bsdf.decode(bb, load_streaming=True)
+        return ls.count if ls.count >= 0 else None
+
+    # Checkpoint every 3 items
+    ls = bsdf.ListStream(sync_items=3)
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, ls)
+        ls.append(1)
+        ls.append(2)
+        assert header_count() is None
+        ls.append(3)
+        assert header_count() == 3
+        ls.append(4)
+        assert header_count() == 3
+        ls.sync()
+        assert header_count() == 4
+        ls.append(5)
+    assert header_count() == 4  # crash: item 5 is not visible ...
+    assert bsdf.recover_stream(tempfilename) == 5  # ... but can be recovered
+    assert bsdf.load(tempfilename) == [1, 2, 3, 4, 5]
+
+    # Checkpoint by time
+    ls = bsdf.ListStream(sync_interval=0.001)
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, ls)
+        ls._sync_time -= 1
+        ls.append(1)
+        assert header_count() == 1
+        ls._sync_time += 3600
+        ls.append(2)
+        assert header_count() == 1
+        ls.close()
+        assert header_count() == 2
+
+    # Checkpoint by time, also when no more items are appended
+    ls = bsdf.ListStream(sync_interval=0.05)
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, ls)
+        for i in range(2):
+            ls.append(i + 1)
+            etime = time.time() + 5
+            while header_count() != i + 1 and time.time() < etime:
+                time.sleep(0.01)
+            assert header_count() == i + 1
+        ls.close()
+
+    # A torn item at the end is dropped by recovery
+    with open(tempfilename, 'ab') as f:
+        f.write(b's\x05abc')
+    assert bsdf.recover_stream(tempfilename) == 2
+    assert bsdf.load(tempfilename) == [1, 2]
+
+    # Group commit, with concurrent appends
+    import threading
+    ls = bsdf.ListStream(group_commit=True)
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, ls)
+
+        def appender(j):
+            for i in range(50):
+                ls.append(j * 100 + i)
+                assert header_count() >= ls._synced_count > 0
+
+        threads = [threading.Thread(target=appender, args=(j, ))
+                   for j in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert header_count() == 200
+    assert sorted(bsdf.load(tempfilename)) == sorted(j * 100 + i
+                                                     for j in range(4)
+                                                     for i in range(50))
+
+    # Only for write mode with a file
+    ls = bsdf.ListStream(sync_items=1)
+    with raises(IOError):
+        ls.sync()
+
+
 ## Blobs
 
 def test_blob_writing1():
@@ -406,6 +1006,537 @@ def test_blob_modding3():  # actual files
     assert bsdf.load(tempfilename) == b'xxyyaa'
 
 
+def test_blob_resizing():
+
+    # Small blob (single-byte sizes)
+    bb = bsdf.encode(bsdf.Blob(b'xxyyzz', extra_size=4, use_checksum=True))
+    f = io.BytesIO(bb)
+    blob = bsdf.load(f, lazy_blob=True)
+    blob.resize(8)
+    assert blob.used_size == blob.data_size == 8
+    blob.seek(6)
+    blob.write(b'ab')
+    blob.update_checksum()
+    assert bsdf.decode(f.getvalue()) == b'xxyyzzab'
+    blob.resize(2)
+    assert bsdf.decode(f.getvalue()) == b'xx'
+    with raises(IOError):
+        blob.resize(11)
+    blob.resize(10)
+    assert bsdf.decode(f.getvalue()) == b'xxyyzzab\x00\x00'
+
+    # Large blob (wide sizes)
+    bb = bsdf.encode([bsdf.Blob(b'x' * 200, extra_size=100), 3])
+    f = io.BytesIO(bb)
+    blob = bsdf.load(f, lazy_blob=True)[0]
+    blob.resize(300)
+    blob.seek(200)
+    blob.write(b'y' * 100)
+    assert bsdf.decode(f.getvalue()) == [b'x' * 200 + b'y' * 100, 3]
+
+    # Cannot grow a blob beyond 250 if its sizes are encoded in one byte
+    bb = bsdf.encode(None)[:-1] + b'b\xfd' + struct.pack('<Q', 300)
+    bb += b'\xc8\xc8' + b'\x00\x00\x00' + b'x' * 200 + b'\x00' * 100
+    f = io.BytesIO(bb)
+    blob = bsdf.load(f, lazy_blob=True)
+    blob.resize(250)
+    with raises(IOError):
+        blob.resize(251)
+    assert bsdf.decode(f.getvalue()) == b'x' * 200 + b'\x00' * 50
+
+    # Fails
+    with raises(RuntimeError):
+        bsdf.Blob(b'xx').resize(1)
+    blob = bsdf.decode(bsdf.encode(bsdf.Blob(b'xx', compression=1)),
+                       lazy_blob=True)
+    with raises(IOError):
+        blob.resize(1)
+
+
+def test_blob_reserve():
+
+    with raises(TypeError):
+        bsdf.BsdfSerializer(blob_reserve=-1)
+    with raises(TypeError):
+        bsdf.BsdfSerializer(blob_reserve='pow3')
+
+    for reserve, size in [(0, 100), (0.5, 150), (2, 300), ('pow2', 128)]:
+        bb = bsdf.encode(b'x' * 100, blob_reserve=reserve)
+        blob = bsdf.decode(bb, lazy_blob=True)
+        assert blob.allocated_size == size and blob.used_size == 100
+        assert bsdf.decode(bb) == b'x' * 100
+
+    # Large reserves are sparse in actual files
+    bsdf.save(tempfilename, [b'x' * 1000000], blob_reserve=100)
+    assert os.path.getsize(tempfilename) > 100 * 1000000
+    with open(tempfilename, 'r+b') as f:
+        blob = bsdf.load(f, lazy_blob=True)[0]
+        blob.resize(2000000)
+        blob.seek(1000000)
+        blob.write(b'y' * 1000000)
+    assert bsdf.load(tempfilename) == [b'x' * 1000000 + b'y' * 1000000]
+    os.remove(tempfilename)
+
+
+def test_blob_from_file():
+
+    data = b'header' + b'x' * 50000 + bytes(bytearray(range(256))) * 100
+    srcname = tempfilename + '.src'
+    with open(srcname, 'wb') as f:
+        f.write(data)
+
+    class ReadOnlyFile(object):
+        """ A file that cannot seek and records the size of reads. """
+        def __init__(self, bb):
+            self._f = io.BytesIO(bb)
+            self.reads = []
+
+        def read(self, n):
+            self.reads.append(n)
+            return self._f.read(n)
+
+    class WriteOnlyFile(object):
+        def __init__(self):
+            self._f = io.BytesIO()
+
+        def write(self, bb):
+            self._f.write(bb)
+
+        def tell(self):
+            return self._f.tell()
+
+    try:
+        # Results equal those from in-memory blobs, for all code paths
+        for compression in (0, 1, 2):
+            for use_checksum in (False, True):
+                kwargs = dict(compression=compression, extra_size=10,
+                              use_checksum=use_checksum)
+                expected = bsdf.encode([1, bsdf.Blob(data, **kwargs)])
+                f = io.BytesIO(b'skip' + data)
+                f.seek(4)  # read from the current position
+                for source in (srcname, f):
+                    blob = bsdf.Blob.from_file(source, **kwargs)
+                    assert bsdf.encode([1, blob]) == expected
+                    # Also when the output cannot seek
+                    f2 = WriteOnlyFile()
+                    bsdf.save(f2, [1, blob])
+                    assert f2._f.getvalue() == expected
+                    assert blob.data_size == len(data)
+                    assert blob.get_bytes() == data
+                # Sources that cannot seek can be written once
+                source = ReadOnlyFile(data)
+                blob = bsdf.Blob.from_file(source, chunk_size=1000, **kwargs)
+                assert bsdf.encode([1, blob]) == expected
+                assert max(source.reads) == 1000
+                with raises(IOError):
+                    bsdf.encode(blob)
+                # And need a seekable output to determine sizes
+                blob = bsdf.Blob.from_file(ReadOnlyFile(data), **kwargs)
+                with raises(IOError):
+                    bsdf.save(WriteOnlyFile(), blob)
+
+        # Written blobs can be loaded lazily, and modified
+        bsdf.save(tempfilename, {'a': bsdf.Blob.from_file(srcname)})
+        with open(tempfilename, 'r+b') as f:
+            blob = bsdf.load(f, lazy_blob=True)['a']
+            assert blob.get_bytes() == data
+            blob.seek(0)
+            blob.write(b'HEADER')
+        assert bsdf.load(tempfilename)['a'] == b'HEADER' + data[6:]
+
+        # Changes of the source are detected (if found out in time)
+        blob = bsdf.Blob.from_file(srcname, compression=1)
+        bsdf.encode(blob)
+        with open(srcname, 'ab') as f:
+            f.write(b'more')
+        with raises(IOError):
+            bsdf.save(WriteOnlyFile(), blob)
+
+        with raises(TypeError):
+            bsdf.Blob.from_file(srcname, compression='zlib')
+    finally:
+        os.remove(srcname)
+
+
+def test_blob_cache():
+    import pickle
+
+    data = [b'x' * 1000, b'y' * 1000, b'z' * 1000]
+    bsdf.save(tempfilename, data, compression='zlib')
+
+    cache = bsdf.BlobCache(2500)
+    with open(tempfilename, 'rb') as f:
+        blobs = bsdf.load(f, lazy_blob=True, blob_cache=cache)
+        assert [blob.get_bytes() for blob in blobs] == data
+        assert cache.misses == 3 and cache.hits == 0
+        assert len(cache) == 2 and cache.size == 2000  # x was evicted
+        assert blobs[2].get_bytes() == data[2]
+        assert blobs[1].get_bytes() == data[1]
+        assert cache.hits == 2
+        assert blobs[0].get_bytes() == data[0]
+        assert cache.misses == 4
+        assert len(cache) == 2  # z was evicted
+        # Content is not read from the file on a hit
+        f.close()
+        assert blobs[0].get_bytes() == data[0]
+
+    # Shared between files with the same path
+    with open(tempfilename, 'rb') as f:
+        blobs = bsdf.load(f, lazy_blob=True, blob_cache=cache)
+        assert blobs[1].get_bytes() == data[1]
+        assert cache.hits == 4
+
+    # Invalidated on write
+    bsdf.save(tempfilename, data)
+    with open(tempfilename, 'r+b') as f:
+        blobs = bsdf.load(f, lazy_blob=True, blob_cache=cache)
+        assert blobs[1].get_bytes() == data[1]
+        blobs[1].seek(0)
+        blobs[1].write(b'a')
+        assert blobs[1].get_bytes() == b'a' + b'y' * 999
+        blobs[1].resize(10)
+        assert blobs[1].get_bytes() == b'a' + b'y' * 9
+        f.seek(0)
+        bsdf.BsdfSerializer(blob_cache=cache).patch(f, [1], b'bb')
+        f.seek(0)
+        blobs = bsdf.load(f, lazy_blob=True, blob_cache=cache)
+        assert blobs[1].get_bytes() == b'bb'
+    assert 'hits' in repr(cache)
+
+    # Not confused with the contents of a rewritten file
+    bsdf.save(tempfilename, [b'x' * 100])
+    with open(tempfilename, 'rb') as f:
+        blob = bsdf.load(f, lazy_blob=True, blob_cache=cache)[0]
+        assert blob.get_bytes() == b'x' * 100
+    os.utime(tempfilename, (0, 0))  # old mtime
+    bsdf.save(tempfilename, [b'y' * 100])
+    with open(tempfilename, 'rb') as f:
+        blob = bsdf.load(f, lazy_blob=True, blob_cache=cache)[0]
+        assert blob.get_bytes() == b'y' * 100
+
+    # Huge contents are not cached
+    bsdf.save(tempfilename, [b'x' * 3000])
+    with open(tempfilename, 'rb') as f:
+        blob = bsdf.load(f, lazy_blob=True, blob_cache=cache)[0]
+        assert blob.get_bytes() == b'x' * 3000
+    assert cache.size <= cache.max_bytes
+
+    # Pickles as an empty cache
+    cache2 = pickle.loads(pickle.dumps(cache))
+    assert len(cache2) == 0 and cache2.max_bytes == 2500
+    cache.clear()
+    assert len(cache) == 0 and cache.size == 0
+
+    with raises(TypeError):
+        bsdf.BsdfSerializer(blob_cache={})
+
+
+def test_file_pool():
+
+    dirname = os.path.dirname(tempfilename)
+    filenames = [os.path.join(dirname, 'pool%i.bsdf' % i) for i in range(20)]
+    for i, filename in enumerate(filenames):
+        ls = bsdf.ListStream()
+        with open(filename, 'wb') as f:
+            bsdf.save(f, OrderedDict([
+                ('data', b'x' * 100 + bytes(bytearray([i]))), ('items', ls)]))
+            ls.append(i)
+            ls.append(i + 1)
+
+    pool = bsdf.FilePool(5)
+    obs = [bsdf.load(pool.open(filename), lazy_blob=True,
+                     load_streaming=True) for filename in filenames]
+    assert len(pool) == 5 and pool.opens == 20
+
+    # Blobs and streams reopen their file when needed
+    for i, ob in enumerate(obs):
+        assert ob['data'].get_bytes() == b'x' * 100 + bytes(bytearray([i]))
+    for i, ob in enumerate(obs):
+        assert list(ob['items']) == [i, i + 1]
+    for i, ob in enumerate(obs):
+        ob['data'].seek(100)
+        assert ob['data'].read(1) == bytes(bytearray([i]))
+    assert len(pool) == 5 and pool.opens > 20
+
+    # Interleaved access through one handle keeps positions apart
+    f1, f2 = pool.open(filenames[0]), pool.open(filenames[0])
+    assert f1.read(4) == b'BSDF'
+    assert f2.read(2) == b'BS'
+    assert f1.read(2) == bytes(bytearray(bsdf.VERSION[:2]))
+    assert f2.read(2) == b'DF'
+    f1.seek(-2, 2)
+    assert f1.tell() == os.path.getsize(filenames[0]) - 2
+
+    # Writing
+    pool.close()
+    assert len(pool) == 0
+    with pool:
+        f = pool.open(filenames[0], 'r+b')
+        blob = bsdf.load(f, lazy_blob=True, load_streaming=True)['data']
+        blob.seek(0)
+        blob.write(b'yy')
+        f.flush()
+    assert bsdf.load(filenames[0])['data'][:3] == b'yyx'
+
+    f.close()
+    with raises(ValueError):
+        f.read(1)
+    with raises(ValueError):
+        pool.open(filenames[0], 'wb')
+    with raises(IOError):
+        pool.open(filenames[0] + '.notexist')
+
+    for filename in filenames:
+        os.remove(filename)
+
+
+def _blob_size_worker(blob):
+    return len(blob.get_bytes())
+
+
+def test_pickle_blob_and_stream():
+    import pickle
+    import multiprocessing
+
+    ls = bsdf.ListStream()
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, OrderedDict([('blobs', [b'x' * i for i in range(1, 20)]),
+                                  ('items', ls)]))
+        for i in range(5):
+            ls.append(i)
+        ls.close()
+
+    with open(tempfilename, 'rb') as f:
+        ob = bsdf.load(f, lazy_blob=True, load_streaming=True)
+        blobs, ls = ob['blobs'], ob['items']
+
+        # Blobs pickle as references into the file
+        bb = pickle.dumps(blobs)
+        assert len(bb) < 5000
+        blobs2 = pickle.loads(bb)
+        assert [b.get_bytes() for b in blobs2] == \
+            [b'x' * i for i in range(1, 20)]
+        assert blobs2[0]._f.name == os.path.abspath(tempfilename)
+
+        # Streams pickle at their current position
+        assert ls.next() == 0
+        ls2 = pickle.loads(pickle.dumps(ls))
+        assert list(ls2) == [1, 2, 3, 4]
+        assert list(ls) == [1, 2, 3, 4]
+
+        # Send to worker processes
+        pool = multiprocessing.Pool(2)
+        try:
+            sizes = pool.map(_blob_size_worker, blobs)
+        finally:
+            pool.close()
+            pool.join()
+        assert sizes == list(range(1, 20))
+
+    # Blobs from bytes pickle as usual
+    blob = pickle.loads(pickle.dumps(bsdf.Blob(b'xyz', compression=1)))
+    assert bsdf.decode(bsdf.encode(blob)) == b'xyz'
+
+    # Not for anonymous files, and not for streams in write mode
+    blob = bsdf.decode(bsdf.encode(b'xyz'), lazy_blob=True)
+    with raises(TypeError):
+        pickle.dumps(blob)
+    with raises(TypeError):
+        pickle.dumps(bsdf.ListStream())
+
+
+## Shared memory
+
+
+def _shared_memory_worker(message):
+    with message:
+        ob = message.load()
+        result = ob['meta'], bytes(ob['blob'])
+        del ob
+    return result
+
+
+def test_shared_memory_message():
+    try:
+        from multiprocessing import shared_memory  # noqa
+    except ImportError:
+        skip('need multiprocessing.shared_memory')
+    import pickle
+    import multiprocessing
+
+    data = dict(meta=[1, 2.5, 'foo'], blob=b'x' * 1000,
+                zblob=bsdf.Blob(b'y' * 1000, compression=1))
+    message = bsdf.SharedMemoryMessage.create(data)
+    ob = None
+    try:
+        assert message.size == len(bsdf.encode(data))
+        assert 'SharedMemoryMessage' in repr(message)
+
+        # Uncompressed blobs are views into the shared memory
+        ob = message.load()
+        assert ob['meta'] == [1, 2.5, 'foo']
+        assert isinstance(ob['blob'], memoryview)
+        assert ob['blob'] == b'x' * 1000
+        assert ob['zblob'] == b'y' * 1000
+        i = bytes(message._shm.buf).index(b'x' * 1000)
+        message._shm.buf[i + 1] = ord('z')
+        assert ob['blob'][:3] == b'xzx'
+        message._shm.buf[i + 1] = ord('x')
+        with raises(BufferError):
+            message.close()  # views exist
+        del ob
+
+        # Attach by name, or unpickle, e.g. in another process
+        message2 = pickle.loads(pickle.dumps(message))
+        with message2:
+            assert message2.name == message.name
+            assert message2.size == message.size
+            assert message2.load(lazy_blob=True)['blob'].get_bytes() == \
+                b'x' * 1000
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(_shared_memory_worker, (message, ))
+        finally:
+            pool.close()
+            pool.join()
+        assert result == ([1, 2.5, 'foo'], b'x' * 1000)
+        with raises(RuntimeError):
+            message2.unlink()  # only by the creator
+    finally:
+        ob = None
+        message.close()
+        message.unlink()
+
+    # ndarrays are views too
+    try:
+        import numpy as np
+    except ImportError:
+        pass
+    else:
+        a = np.arange(1000, dtype='float32').reshape(10, 100)
+        with bsdf.SharedMemoryMessage.create([a]) as message:
+            b = message.load()[0]
+            assert np.all(a == b) and b.dtype == a.dtype
+            assert not b.flags.owndata
+            del b
+            message.unlink()
+
+    with raises(ValueError):
+        bsdf.SharedMemoryMessage.create([bsdf.ListStream()])
+
+
+## Remote files
+
+
+def _serve_range_requests(files, support_range=True):
+    """ Serve the given dict of path -> bytes over HTTP, supporting range
+    requests. Returns the server and a list of received Range headers.
+    """
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+    except ImportError:
+        skip('need http.server')
+    import threading
+
+    ranges = []
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            data = files[self.path]
+            range = self.headers.get('Range')
+            ranges.append(range)
+            if range and support_range:
+                start, stop = range.split('=')[1].split('-')
+                start, stop = int(start), min(int(stop) + 1, len(data))
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %i-%i/%i' %
+                                 (start, stop - 1, len(data)))
+                data = data[start:stop]
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server, ranges
+
+
+def test_http_range_file():
+
+    data = dict(meta={'name': 'foo'},
+                blobs=[b'a' * 300000, b'b' * 300000, b'c' * 100])
+    ls = bsdf.ListStream()
+    f = io.BytesIO()
+    bsdf.save(f, OrderedDict([('data', data), ('items', ls)]))
+    for i in range(10):
+        ls.append(i)
+    ls.close()
+    bb = f.getvalue()
+
+    server, ranges = _serve_range_requests({'/a.bsdf': bb})
+    url = 'http://127.0.0.1:%i/a.bsdf' % server.server_address[1]
+    try:
+        # Full load
+        with bsdf.HttpRangeFile(url) as f:
+            assert f.size == len(bb)
+            ob = bsdf.load(f)
+        assert ob['data'] == data and ob['items'] == list(range(10))
+        assert f.closed
+
+        # Lazy load only fetches what is touched
+        ranges[:] = []
+        f = bsdf.HttpRangeFile(url, block_size=1000, cache_blocks=4)
+        ob = bsdf.load(f, lazy_blob=True, load_streaming=True)
+        assert ob['data']['meta'] == {'name': 'foo'}
+        assert list(ob['items']) == list(range(10))
+        blob = ob['data']['blobs'][1]
+        assert f.requests < 10
+        blob.seek(150000)
+        assert blob.read(2500) == b'b' * 2500
+        assert ranges[-1] == 'bytes=%i-%i' % (
+            (blob.start_pos + 150000) // 1000 * 1000,
+            (blob.start_pos + 152500) // 1000 * 1000 + 999)  # coalesced
+        n = f.requests
+        blob.seek(150000)
+        assert blob.read(1000) == b'b' * 1000
+        assert f.requests == n  # cached
+        assert ob['data']['blobs'][2].get_bytes() == b'c' * 100
+        assert sum(int(r.split('-')[1]) - int(r.split('=')[1].split('-')[0])
+                   for r in ranges) < 20000
+
+        # Seeking and reading
+        f.seek(-4, 2)
+        assert f.read() == bb[-4:]
+        f.seek(0)
+        assert f.read(4) == b'BSDF'
+        f.seek(10, 1)
+        assert f.tell() == 14
+        assert f.read(1000000) == bb[14:]
+        f.close()
+        with raises(ValueError):
+            f.read(1)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # The server must support range requests
+    server, ranges = _serve_range_requests({'/a.bsdf': bb}, False)
+    url = 'http://127.0.0.1:%i/a.bsdf' % server.server_address[1]
+    try:
+        with raises(IOError):
+            bsdf.HttpRangeFile(url)
+    finally:
+        server.shutdown()
+        server.server_close()
+
 if __name__ == '__main__':
 
     for name, func in list(globals().items()):
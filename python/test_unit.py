@@ -8,6 +8,7 @@ import os
 import io
 import sys
 import array
+import struct
 import logging
 import tempfile
 
@@ -181,6 +182,135 @@ def test_loaders_and_savers():
     assert s1 == s2
 
 
+def test_load_all_save_all():
+
+    obs = [dict(foo=42), [1, 2.1, b'eggs' * 100, 'ham' * 2000], 'spam', None,
+           3 + 4j]
+
+    for length_prefix in (False, True):
+
+        # In-memory, and using a very strict file object (that cannot seek),
+        # at an unaligned offset; the results are the same.
+        results = []
+        for f in (io.BytesIO(), StrictWriteFile(io.BytesIO())):
+            f.write(b'xyz')
+            bsdf.save_all(f, iter(obs), length_prefix=length_prefix)
+            bb = f.f.getvalue() if isinstance(f, StrictWriteFile) else f.getvalue()
+            results.append(bb)
+            bb = bb[3:]
+            assert bb.count(b'BSDF') == len(obs)
+            assert list(bsdf.load_all(io.BytesIO(bb), length_prefix=length_prefix)) == obs
+            res = bsdf.load_all(StrictReadFile(io.BytesIO(bb)), length_prefix=length_prefix)
+            assert list(res) == obs
+
+        assert results[0] == results[1]
+
+        # Using a filename
+        bsdf.save_all(tempfilename, obs, length_prefix=length_prefix)
+        res = bsdf.load_all(tempfilename, length_prefix=length_prefix)
+        assert next(res) == obs[0]  # lazy
+        assert list(res) == obs[1:]
+
+        # Skipping
+        skip = lambda i: i % 2 == 1
+        for f in (io.BytesIO(bb), StrictReadFile(io.BytesIO(bb))):
+            res = bsdf.load_all(f, length_prefix=length_prefix, skip=skip)
+            assert list(res) == obs[::2]
+
+    # Length prefix means one can skip without parsing
+    bb = bsdf.encode(4)
+    bb = struct.pack('<Q', 3) + b'BSD' + struct.pack('<Q', len(bb)) + bb
+    assert list(bsdf.load_all(io.BytesIO(bb), length_prefix=True,
+                              skip=lambda i: i == 0)) == [4]
+
+    # Truncated prefix
+    with raises(EOFError):
+        list(bsdf.load_all(io.BytesIO(b'\x03\x00'), length_prefix=True))
+    # Not BSDF
+    with raises(RuntimeError):
+        list(bsdf.load_all(io.BytesIO(bsdf.encode(3) + b'BZDF\x02\x00v')))
+
+    # No streams
+    with raises(ValueError):
+        bsdf.save_all(io.BytesIO(), [1, [2, bsdf.ListStream()]])
+
+    # Files that can seek, but have no seekable() (e.g. on Legacy Python)
+    class LegacyFile(StrictWriteFile):
+        def seek(self, pos, whence=0):
+            return self.f.seek(pos, whence)
+
+    assert bsdf._seekable(LegacyFile(io.BytesIO()))
+    assert not bsdf._seekable(StrictWriteFile(io.BytesIO()))
+
+    # Truncated blobs are detected, also without seeking
+    bb = bsdf.encode([1, b'x' * 100])[:-10]
+    for f in (io.BytesIO(bb), StrictReadFile(io.BytesIO(bb))):
+        with raises(EOFError):
+            bsdf.load(f)
+
+    # Truncated values are detected when skipping, also without seeking
+    bb = bsdf.encode([1, 'x' * 10, 2.5])[:-3]
+    for f in (io.BytesIO(bb), StrictReadFile(io.BytesIO(bb))):
+        with raises(EOFError):
+            list(bsdf.load_all(f, skip=lambda i: True))
+
+
+def test_load_cache():
+
+    cache = bsdf.LoadCache(1000)
+    data = {'a': [1, 2, 3], 'b': 'x' * 100}
+    bsdf.save(tempfilename, data)
+
+    # Shared objects
+    ob1 = bsdf.load(tempfilename, cache=cache)
+    ob2 = bsdf.load(tempfilename, cache=cache)
+    assert ob1 == data and ob2 is ob1
+    assert cache.hits == 1 and cache.misses == 1
+    assert cache.size == os.path.getsize(tempfilename)
+
+    # Options are part of the key
+    ob3 = bsdf.load(tempfilename, cache=cache, numeric_lists='array')
+    assert ob3 is not ob1
+    assert ob3['a'] == array.array(bsdf._INT64_TYPECODE, [1, 2, 3])
+    assert bsdf.load(tempfilename, cache=cache, extensions=[]) is not ob1
+    assert len(cache) == 3
+
+    # Changes are detected
+    data['c'] = None
+    bsdf.save(tempfilename, data)
+    ob4 = bsdf.load(tempfilename, cache=cache)
+    assert ob4 == data and ob4 is not ob1
+    assert bsdf.load(tempfilename, cache=cache) is ob4
+
+    # Eviction
+    assert cache.size <= 1000
+    bsdf.save(tempfilename, b'x' * 900)
+    assert bsdf.load(tempfilename, cache=cache) == b'x' * 900
+    assert len(cache) == 1 and cache.size < 1000
+    bsdf.save(tempfilename, b'x' * 1200)
+    assert bsdf.load(tempfilename, cache=cache) == b'x' * 1200
+    assert len(cache) == 0  # too large
+
+    # Copies
+    cache = bsdf.LoadCache(copy=True)
+    bsdf.save(tempfilename, data)
+    ob1 = bsdf.load(tempfilename, cache=cache)
+    ob1['a'].append(4)
+    assert bsdf.load(tempfilename, cache=cache) == data
+    assert cache.hits == 1 and 'hits' in repr(cache)
+    cache.invalidate(tempfilename)
+    assert len(cache) == 0 and cache.size == 0
+    bsdf.load(tempfilename, cache=cache)
+    cache.clear()
+    assert len(cache) == 0
+
+    # Only for whole files
+    with raises(TypeError):
+        bsdf.load(io.BytesIO(bsdf.encode(3)), cache=cache)
+    with raises(ValueError):
+        bsdf.load(tempfilename, cache=cache, lazy_blob=True)
+
+
 def test_loaders_and_savers_of_serializer():
 
     s1 = dict(foo=42, bar=[1, 2.1, False, 'spam', b'eggs'])
@@ -232,6 +362,378 @@ def test_compression():
 
 
 
+def test_parallel_encoding():
+
+    data1 = [[i, 'x' * (i % 7), float(i)] for i in range(5000)]
+    data2 = dict(('k%i' % i, {'a': i, 'b': b'x' * (i % 11)})
+                 for i in range(5000))
+    data3 = [b'x' * (i % 13) if i % 3 else i for i in range(5000)]
+
+    for data in (data1, data2, data3):
+        for compression in (0, 1):
+            bb1 = bsdf.encode(data, compression=compression)
+            bb2 = bsdf.encode(data, compression=compression, workers=2)
+            assert bb1 == bb2
+            assert bsdf.decode(bb2) == data
+
+    # Segments are realigned, not encoded again, at unaligned offsets
+    calls = []
+    encode_items = bsdf.BsdfSerializer._encode_items
+
+    def counting_encode_items(self, f, items, is_dict, streams):
+        calls.append(len(items))
+        return encode_items(self, f, items, is_dict, streams)
+
+    bsdf.BsdfSerializer._encode_items = counting_encode_items
+    try:
+        for offset in range(8):
+            f1, f2 = io.BytesIO(b'x' * offset), io.BytesIO(b'x' * offset)
+            f1.seek(offset)
+            f2.seek(offset)
+            bsdf.save(f1, data3)
+            bsdf.save(f2, data3, workers=2)
+            assert f1.getvalue() == f2.getvalue()
+    finally:
+        bsdf.BsdfSerializer._encode_items = encode_items
+    assert calls == [0] * 8  # only the (empty) tail in this process
+
+    # Segments are pickled rather than forked while other threads run
+    import threading
+    event = threading.Event()
+    t = threading.Thread(target=event.wait)
+    t.start()
+    try:
+        assert bsdf.encode(data2, workers=2) == bsdf.encode(data2)
+    finally:
+        event.set()
+        t.join()
+
+    # Small collections are encoded serially
+    assert bsdf.encode([1, 2], workers=2) == bsdf.encode([1, 2])
+
+    # A stream at the end
+    ls = bsdf.ListStream()
+    f = io.BytesIO()
+    bsdf.save(f, data3 + [ls], workers=2)
+    ls.append(3)
+    assert bsdf.decode(f.getvalue()) == data3 + [[3]]
+
+    # But not elsewhere
+    with raises(ValueError):
+        bsdf.encode([bsdf.ListStream()] + data3, workers=2)
+
+
+def test_background_io():
+
+    data = [[i, 'x' * (i % 7), b'y' * (i % 23), float(i)] for i in range(500)]
+    bb = bsdf.encode(data)
+
+    default_chunk_size = bsdf._BACKGROUND_IO_CHUNK_SIZE
+    for chunk_size in (default_chunk_size, 1000, 7):
+        bsdf._BACKGROUND_IO_CHUNK_SIZE = chunk_size
+        try:
+            # Output is byte-identical
+            f = io.BytesIO()
+            bsdf.save(f, data, background_io=True)
+            assert f.getvalue() == bb
+            f1, f2 = io.BytesIO(b'xx'), io.BytesIO(b'xx')
+            f1.seek(2)
+            f2.seek(2)
+            bsdf.save(f1, data)
+            bsdf.save(StrictWriteFile(f2), data, background_io=True)
+            assert f1.getvalue() == f2.getvalue()
+
+            # Load; the file is left at the end of the document
+            f = io.BytesIO(bb + b'more')
+            assert bsdf.load(f, background_io=True) == data
+            assert f.read() == b'more'
+            f = io.BytesIO(bb)
+            assert bsdf.load(StrictReadFile(f), background_io=True) == data
+            with raises(struct.error):  # truncated, as without background_io
+                bsdf.load(io.BytesIO(bb[:-5]), background_io=True)
+
+            # Streams continue on the real file
+            ls = bsdf.ListStream()
+            f = io.BytesIO()
+            bsdf.save(f, [1, ls], background_io=True)
+            ls.append(2)
+            ls.close()
+            assert bsdf.decode(f.getvalue()) == [1, [2]]
+        finally:
+            bsdf._BACKGROUND_IO_CHUNK_SIZE = default_chunk_size
+
+    # Lazy loading does not use background reads
+    f = io.BytesIO(bb)
+    assert bsdf.load(f, background_io=True, lazy_blob=True)[1][0] == 1
+
+    # Closing does not hang on a read that blocks (e.g. from a pipe)
+    r, w = os.pipe()
+    default_timeout = bsdf._PREFETCH_CLOSE_TIMEOUT
+    bsdf._PREFETCH_CLOSE_TIMEOUT = 0.1
+    try:
+        with io.open(r, 'rb', buffering=0) as fr:
+            f = bsdf._PrefetchFile(fr, 16)
+            f.close()
+            assert f._thread is None
+            os.close(w)  # ends the blocked read
+    finally:
+        bsdf._PREFETCH_CLOSE_TIMEOUT = default_timeout
+
+    # Write errors are raised
+    class FailingFile(object):
+        def tell(self):
+            return 0
+
+        def write(self, bb):
+            raise IOError('disk full')
+
+    with raises(IOError):
+        bsdf.save(FailingFile(), data, background_io=True)
+
+
+def test_buffer_blobs():
+    import mmap
+
+    data = b'abcdefgh' * 100
+
+    # Buffer-protocol objects are encoded as blobs
+    m = mmap.mmap(-1, len(data))
+    m.write(data)
+    for value in (bytearray(data), memoryview(data), m,
+                  array.array('H', data)):
+        assert bsdf.decode(bsdf.encode([value])) == [data]
+        for compression in (1, 2):
+            bb = bsdf.encode(value, compression=compression)
+            assert bsdf.decode(bb) == data
+        assert bsdf.encode(bsdf.Blob(value)) == bsdf.encode(data)
+
+    # Blobs refer to the data, rather than copying it
+    buf = bytearray(data)
+    blob = bsdf.Blob(buf)
+    assert blob.compressed.obj is buf
+    buf[0] = ord('X')
+    assert bsdf.decode(bsdf.encode(blob))[:2] == b'Xb'
+
+    # Extensions take precedence
+    class BytearrayExtension(bsdf.Extension):
+        name = 'bytearray'
+        cls = bytearray
+
+        def encode(self, s, v):
+            return bytes(v)
+
+        def decode(self, s, v):
+            return bytearray(v)
+
+    ob = bsdf.decode(bsdf.encode([buf], [BytearrayExtension]),
+                     [BytearrayExtension])
+    assert isinstance(ob[0], bytearray) and ob[0] == buf
+
+    # Non-contiguous buffers are refused
+    with raises(ValueError):
+        bsdf.encode(memoryview(data)[::2])
+    with raises(TypeError):
+        bsdf.Blob(42)
+
+    # Numpy arrays are also encoded from their buffer
+    try:
+        import numpy as np
+    except ImportError:
+        return
+    a = np.arange(1000, dtype='float32').reshape(10, 100)
+    buffers = []
+    bb = bsdf.encode(a, buffer_callback=buffers.append)
+    assert np.shares_memory(np.asarray(buffers[0]), a)
+    assert np.all(bsdf.decode(bb, buffers=buffers) == a)
+    assert np.all(bsdf.decode(bsdf.encode(a.T)) == a.T)
+
+
+def test_vectored_io():
+
+    if not hasattr(os, 'writev'):
+        skip('os.writev is not available')
+
+    payload = b'x' * 100000
+    data = [1, 'foo', payload, {'a': bsdf.Blob(b'y' * 5000, extra_size=9)},
+            bsdf.Blob(b'z' * 7000, compression=1), [3.5] * 100]
+
+    # Large payloads are passed to writev as-is
+    writev_calls = []
+    original_writev = os.writev
+
+    def writev(fd, buffers):
+        writev_calls.append([bytes(b) if len(b) < 1000 else b.obj
+                             for b in buffers])
+        return original_writev(fd, buffers)
+
+    os.writev = writev
+    try:
+        # Output is byte-identical, also at an unaligned offset
+        with io.open(tempfilename, 'wb', buffering=0) as f:
+            f.write(b'abc')
+            bsdf.save(f, data, vectored_io=True)
+            f.write(b'def')
+    finally:
+        os.writev = original_writev
+    with open(tempfilename, 'rb') as f:
+        bb = f.read()
+    assert len(writev_calls) == 1
+    assert any(b is payload for b in writev_calls[0])
+    f = io.BytesIO()
+    f.write(b'abc')
+    bsdf.save(f, data)
+    f.write(b'def')
+    assert bb == f.getvalue()
+
+    # Buffered files continue at the right position
+    with open(tempfilename, 'wb') as f:
+        f.write(b'abc')
+        bsdf.save(f, data, vectored_io=True)
+        f.write(b'def')
+    with open(tempfilename, 'rb') as f:
+        assert f.read() == bb
+
+    # Streams continue on the real file
+    ls = bsdf.ListStream()
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, [payload, ls], vectored_io=True)
+        ls.append(3)
+        ls.append(payload)
+        ls.close()
+    assert bsdf.load(tempfilename) == [payload, [3, payload]]
+
+    # File objects without file descriptor are written to as usual
+    bb2 = bsdf.encode(data, vectored_io=True)
+    assert bb2 == bsdf.encode(data)
+
+    # Sockets
+    import socket
+    if not hasattr(socket, 'socketpair'):
+        return
+    import threading
+    a, b = socket.socketpair()
+    try:
+        received = []
+        t = threading.Thread(target=lambda: received.extend(
+            iter(lambda: b.recv(2 ** 16), b'')))
+        t.start()
+        bsdf.save(a, data, vectored_io=True)
+        a.shutdown(socket.SHUT_WR)
+        t.join()
+        assert b''.join(received) == bsdf.encode(data)
+        with raises(ValueError):
+            bsdf.save(a, [bsdf.ListStream()], vectored_io=True)
+    finally:
+        a.close()
+        b.close()
+
+
+def test_read_ahead():
+
+    class CountingReadFile(StrictWriteFile):
+        reads = 0
+
+        def read(self, n):
+            self.reads += 1
+            return self.f.read(n)
+
+        def seek(self, pos, whence=0):
+            return self.f.seek(pos, whence)
+
+    data = [[i, 'x' * (i % 7), b'y' * (i % 23), float(i)] for i in range(500)]
+    bb = bsdf.encode(data)
+
+    # Unbuffered sources are read in large chunks
+    f = CountingReadFile(io.BytesIO(bb))
+    assert bsdf.load(f) == data
+    assert f.reads <= len(bb) // bsdf._READ_AHEAD_SIZE + 2
+
+    # Unconsumed bytes are given back to seekable files
+    with open(tempfilename, 'wb') as f:
+        bsdf.save(f, data)
+        bsdf.save(f, [1, 2, 3])
+        f.write(b'more')
+    with io.open(tempfilename, 'rb', buffering=0) as f:
+        assert bsdf.load(f) == data
+        assert bsdf.load(f, numeric_lists='array') == \
+            array.array(bsdf._INT64_TYPECODE, [1, 2, 3])
+        assert f.read() == b'more'
+
+    # Also when loading multiple documents
+    for length_prefix in (True, False):
+        with open(tempfilename, 'wb') as f:
+            bsdf.save_all(f, [data, 1, 2, 3], length_prefix=length_prefix)
+        with io.open(tempfilename, 'rb', buffering=0) as f:
+            it = bsdf.load_all(f, length_prefix=length_prefix,
+                               skip=lambda i: i == 0)
+            assert next(it) == 1
+            assert next(it) == 2
+            it.close()
+            assert list(bsdf.load_all(f, length_prefix=length_prefix)) == [3]
+
+    # Non-seekable sources are not read beyond the document
+    r, w = os.pipe()
+    os.write(w, bsdf.encode([1, 2, 3]) + bsdf.encode('second'))
+    os.close(w)
+    with io.open(r, 'rb', buffering=0) as f:
+        assert bsdf.load(f) == [1, 2, 3]
+        assert bsdf.load(f) == 'second'
+        assert f.read() == b''
+
+
+def test_out_of_band_buffers():
+
+    big1 = b'x' * 1000
+    big2 = bytearray(b'y' * 2000)
+    data = [1, big1, {'a': bsdf.Blob(b'z' * 3000), 'b': b'small'},
+            bsdf.Blob(b'c' * 100, compression=1)]
+
+    # Large buffers are exported, small ones are kept in-band
+    buffers = []
+
+    def callback(buf):
+        if len(buf) < 100:
+            return True
+        buffers.append(buf)
+
+    bb = bsdf.encode(data, buffer_callback=callback)
+    assert len(buffers) == 2
+    assert buffers[0] is big1
+    assert buffers[1] == b'z' * 3000
+    assert len(bb) < 1000
+    assert len(bb) < len(bsdf.encode(data)) - 4000
+
+    # Buffers are returned as-is, in place of the bytes they replaced
+    buffers[0] = big2
+    ob = bsdf.decode(bb, buffers=buffers)
+    assert ob[1] is big2
+    assert ob[2]['a'] is buffers[1]
+    assert ob[2]['b'] == b'small'
+    assert ob[3] == b'c' * 100
+
+    # Any sequence of buffer objects can be given
+    ob = bsdf.decode(bb, buffers=iter([memoryview(big1), b'z']))
+    assert isinstance(ob[1], memoryview)
+    assert ob[2]['a'] == b'z'
+
+    # Buffers are required, and enough of them
+    with raises(ValueError):
+        bsdf.decode(bb)
+    with raises(ValueError):
+        bsdf.decode(bb, buffers=[big1])
+
+    # Without a callback, or when it keeps everything, all is in-band
+    assert bsdf.encode(data, buffer_callback=lambda buf: True) == \
+        bsdf.encode(data)
+
+    # The serializer itself is not affected
+    s = bsdf.BsdfSerializer(compression=0)
+    assert s.encode([big1], buffer_callback=lambda buf: None) != \
+        s.encode([big1])
+    assert s._buffer_callback is None
+    assert s.decode(s.encode([big1])) == [big1]
+
+
 def test_float32():
 
     # Using float32 makes smaller files
@@ -263,6 +765,46 @@ def test_float32():
     assert bsdf.decode(b2) == [300000, 400000, 500000, 3000000, 4000000, 5000000]
 
 
+def test_numeric_lists():
+
+    data = [[1, 2, 3, 300000, -5], [1, 2, 3, 2.5, 1e30, 3], [],
+            [1, 2, 'x', 3], [True, False], [1, None], 3 + 4j]
+
+    with raises(TypeError):
+        bsdf.BsdfSerializer(numeric_lists='list')
+
+    bb = bsdf.encode(data)
+    bb32 = bsdf.encode(data, float64=False)
+    for f in (io.BytesIO(bb), StrictReadFile(io.BytesIO(bb))):
+        res = bsdf.load(f, numeric_lists='array')
+        assert res == [array.array(bsdf._INT64_TYPECODE, data[0]),
+                       array.array('d', data[1]),
+                       [], data[3], data[4], data[5], data[6]]
+    res = bsdf.decode(bb32, numeric_lists='array')
+    assert res[1][:3] == array.array('d', [1.0, 2.0, 3.0])
+    assert res[1].typecode == 'd'
+
+    # Truncated
+    with raises(Exception):
+        bsdf.decode(bsdf.encode([1, 2, 3])[:-1], numeric_lists='array')
+
+    try:
+        import numpy as np
+    except ImportError:
+        skip('need numpy')
+
+    for f in (io.BytesIO(bb), StrictReadFile(io.BytesIO(bb))):
+        res = bsdf.load(f, numeric_lists='numpy')
+        assert res[0].dtype == np.int64 and res[0].tolist() == data[0]
+        assert res[1].dtype == np.float64 and res[1].tolist() == data[1]
+        assert res[2:] == data[2:]
+
+    # Lists in extensions are not affected
+    a = np.arange(6).reshape(2, 3)
+    res = bsdf.decode(bsdf.encode([a, 3 + 4j]), numeric_lists='numpy')
+    assert res[0].shape == (2, 3) and res[1] == 3 + 4j
+
+
 def test_autoconvert_numpy_scalars():
 
     try:
@@ -349,6 +891,51 @@ def test_extension_add_remove():
     assert len(x._extensions) == 0
 
 
+def test_extension_threads():
+    import threading
+
+    class MyExtension(bsdf.Extension):
+        name = 'myob'
+
+        def match(self, s, v):
+            return isinstance(v, MyOb)
+
+        def encode(self, s, v):
+            return v.x
+
+        def decode(self, s, v):
+            return MyOb(v)
+
+    class MyOb(object):
+        def __init__(self, x):
+            self.x = x
+
+    # Encode/decode in threads, while extensions are added and removed
+    s = bsdf.BsdfSerializer([MyExtension, bsdf.ComplexExtension])
+    data = [1.5 + 2j, 'foo', [3, 4], {'a': 5}] * 100
+    errors = []
+
+    def worker():
+        try:
+            for i in range(50):
+                assert s.decode(s.encode(data)) == data
+                assert s.decode(s.encode(MyOb(i))).x == i
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=worker) for i in range(4)]
+    for t in threads:
+        t.start()
+    for i in range(500):
+        s.add_extension(bsdf.NDArrayExtension)
+        s.remove_extension('ndarray')
+    s.add_extension(bsdf.NDArrayExtension)
+    for t in threads:
+        t.join()
+    assert not errors
+    assert set(s._extensions) == set(['myob', 'c', 'ndarray'])
+
+
 def test_standard_extensions_complex():
 
     x = bsdf.BsdfSerializer()